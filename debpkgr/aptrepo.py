@@ -26,14 +26,16 @@ pip install python-debian chardet
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import errno
+import io
+import itertools
 import logging
 import os
 import shutil
 import time
-import gzip
-import bz2
 import tempfile
-import re
+from collections import defaultdict
+from concurrent import futures
 
 from six import string_types
 from debian import deb822
@@ -42,26 +44,68 @@ from . import compressr
 from . import debpkg
 from . import utils
 from . import signer
+from .hashcache import HashCache
+from .hasher import HashFile
+from .hasher import HashingReader
 from .hasher import hash_file
+from .hasher import deb_hash_files
 
 REPO_VERSION = '1.0'
 
 log = logging.getLogger(__name__)
 
 
+def _dump_paragraph(paragraph, path):
+    # deb822 writes one field at a time to a file; serialize it first, and
+    # write it with a single call
+    data = paragraph.dump().encode(paragraph.encoding)
+    with open(path, "wb") as fh:
+        fh.write(data)
+
+
 class AptRepoMeta(object):
-    __slots__ = ['release', '_component_arch_binaries', 'upstream_url']
+    __slots__ = ['release', '_component_arch_binaries', 'upstream_url',
+                 '_split_fields', 'hash_algorithms', 'acquire_by_hash']
     """
     Object for storing Apt Repo MetaData
     """
     _Compression_Types = ['xz', 'bz2', 'gz']
+    # Compressed variants of the Packages files written next to the plain
+    # one. apt prefers xz, then gz; bzip2 is the slowest to produce and is
+    # hardly ever fetched, so it has to be requested explicitly.
+    _Packages_Compression_Types = ['gz', 'xz']
     _Hash_Algorithms = dict(sha1=("sha1", "SHA1"),
                             md5=("md5sum", "MD5sum"),
                             sha256=("sha256", "SHA256"))
+    _Packages_Block_Size = 1 << 20
+    _GZIP_LEVEL = compressr.GZIP_DEFAULT_COMPRESSION
+    # bzip2 levels only change the block size: 9 is half again as slow as
+    # 3, for files a fraction of a percent smaller
+    _BZ2_LEVEL = 3
+    # xz is what clients download, and compresses much better at the
+    # default preset than at the faster ones
+    _XZ_PRESET = 6
+    # Upper bound on the threads compressing one Packages.gz
+    _GZIP_MAX_THREADS = 4
+    # Previous generations of Packages files kept under by-hash, for
+    # clients that still have an older Release file (like apt-ftparchive)
+    _BY_HASH_KEEP = 3
 
     def __init__(self, release=None, origin=None, label=None, version=None,
                  description=None, codename=None, components=None,
-                 architectures=None, upstream_url=None):
+                 architectures=None, upstream_url=None, hash_algorithms=None,
+                 acquire_by_hash=False):
+        """
+        hash_algorithms: digests to record in the Release file for the
+        Packages files (keys of _Hash_Algorithms); defaults to all of them.
+        apt only needs SHA256, and leaving out the others saves hashing
+        every file written.
+        acquire_by_hash: if True, the Packages files are also published
+        under by-hash/SHA256/<digest>, and the Release file tells apt to
+        fetch them from there. Clients then never see a Packages file that
+        does not match the Release file they have, and mirrors can skip
+        the files they already have.
+        """
         if release is None:
             release = deb822.Release()
         else:
@@ -81,17 +125,41 @@ class AptRepoMeta(object):
         self.release.setdefault('Label', label or origin)
         self.release.setdefault('Version', version or REPO_VERSION)
         self.set_date()
-        self._component_arch_binaries = []
+        # (component, architecture) -> ComponentArchBinary
+        self._component_arch_binaries = dict()
+        # field name -> (raw value, tuple of values, frozenset of values)
+        self._split_fields = dict()
         self.upstream_url = upstream_url
-
-    def set_date(self):
-        self.release.setdefault(
-            'Date', time.strftime('%a, %d %b %Y %H:%M:%S +0000',
-                                  time.gmtime()))
+        self.hash_algorithms = hash_algorithms
+        self.acquire_by_hash = acquire_by_hash
+
+    def set_date(self, force=False):
+        # Only format the timestamp if it is going to be used
+        if force or 'Date' not in self.release:
+            self.release['Date'] = time.strftime(
+                '%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+
+    def _split_field_cached(self, name):
+        # Cached on the raw value, so changes made directly to the release
+        # are still picked up
+        raw = self.release.get(name, '')
+        cached = self._split_fields.get(name)
+        if cached is None or cached[0] != raw:
+            values = tuple(raw.split())
+            cached = self._split_fields[name] = (
+                raw, values, frozenset(values))
+        return cached
+
+    def _split_field(self, name):
+        return self._split_field_cached(name)[1]
+
+    def _split_field_set(self, name):
+        # For membership tests
+        return self._split_field_cached(name)[2]
 
     @property
     def architectures(self):
-        return self.release.get('Architectures', '').split()
+        return list(self._split_field('Architectures'))
 
     @architectures.setter
     def architectures(self, values):
@@ -100,7 +168,7 @@ class AptRepoMeta(object):
 
     @property
     def components(self):
-        return self.release.get('Components', '').split()
+        return list(self._split_field('Components'))
 
     @components.setter
     def components(self, values):
@@ -112,42 +180,52 @@ class AptRepoMeta(object):
         return self.release.get('Codename')
 
     def init_component_arch_binaries(self):
-        self._component_arch_binaries = []
-        self._component_arch_binaries.extend(
-            self.iter_component_arch_binaries())
+        self._component_arch_binaries = dict()
+        # Creates all the objects
+        for _ in self.iter_component_arch_binaries():
+            pass
 
     def iter_component_arch_binaries(self):
-        for comp in self.components:
-            for arch in self.architectures:
+        for comp in self._split_field('Components'):
+            for arch in self._split_field('Architectures'):
                 yield self.get_component_arch_binary(comp, arch)
 
     def get_component_arch_binary(self, component, architecture):
         # Retrieves object, or creates it if it doesn't exist
-        for obj in self._component_arch_binaries:
-            if obj.component == component and obj.architecture == architecture:
-                return obj
+        obj = self._component_arch_binaries.get((component, architecture))
+        if obj is not None:
+            return obj
         return self.add_component_arch_binary(
             meta=dict(component=component, architecture=architecture))
 
     def component_arch_binary_package_files_from_release(self):
         digests = ['SHA256', 'SHA1', 'MD5sum']
+        # The (component, architecture) -> directory map does not depend on
+        # the digest, build it only once
+        arch_dirs = [(arch, 'binary-' + arch)
+                     for arch in self._split_field('Architectures')]
+        comparch_paths = []
+        for comp in self._split_field('Components'):
+            # Strip leading directories (updates/main -> main)
+            comp_dir = comp.rpartition('/')[2]
+            for arch, arch_dir in arch_dirs:
+                # Release entries always use / as the separator
+                comparch_paths.append(
+                    ((comp, arch), comp_dir + '/' + arch_dir))
         ret = dict()
         for digest_name in digests:
             if digest_name not in self.release:
                 continue
             comp_arch_bin_packages = dict()
             for entry in self.release[digest_name]:
-                dirname = os.path.dirname(entry['name'])
+                dirname = entry['name'].rpartition('/')[0]
                 comp_arch_bin_packages.setdefault(dirname, []).append(entry)
-            for comp in self.components:
-                for arch in self.architectures:
-                    comparch = (comp, arch)
-                    if comparch in ret:
-                        continue
-                    path = os.path.join(re.sub(r'^.*/', '', comp), 'binary-{}'.format(arch))
-                    if path not in comp_arch_bin_packages:
-                        continue
-                    ret[comparch] = comp_arch_bin_packages[path]
+            for comparch, path in comparch_paths:
+                if comparch in ret:
+                    continue
+                if path not in comp_arch_bin_packages:
+                    continue
+                ret[comparch] = comp_arch_bin_packages[path]
         return ret
 
     def add_component_arch_binary(self, release=None, meta=None):
@@ -157,13 +235,14 @@ class AptRepoMeta(object):
             meta.setdefault('description', self.release['Description'])
         obj = ComponentArchBinary(release=release, meta=meta,
                                   dist=self.release['Codename'])
-        if obj.component not in self.components:
+        if obj.component not in self._split_field_set('Components'):
             raise ValueError("Component %s not supported (expected: %s)" % (
                 obj.component, ', '.join(self.components)))
-        if obj.architecture not in self.architectures:
+        if obj.architecture not in self._split_field_set('Architectures'):
             raise ValueError("Architecture %s not defined (expected: %s)" % (
                 obj.architecture, ', '.join(self.architectures)))
-        self._component_arch_binaries.append(obj)
+        self._component_arch_binaries[
+            (obj.component, obj.architecture)] = obj
         return obj
 
     def release_dir(self, base_path):
@@ -175,22 +254,56 @@ class AptRepoMeta(object):
             self.release_dir(base_path), 'Release')
 
     def create(self, base_path):
-        all_checksums = dict()
-        for obj in self.iter_component_arch_binaries():
-            checksums = obj.write_packages(
-                base_path, self.release_dir(base_path))
-            for k, vlist in checksums.items():
-                all_checksums.setdefault(k, []).extend(vlist)
-        self.release.update(all_checksums)
+        all_checksums = defaultdict(list)
+        release_dir = self.release_dir(base_path)
+        objs = list(self.iter_component_arch_binaries())
+        # Each component/architecture is written to its own directory, and
+        # the work (compression, hashing) releases the GIL. They all share
+        # one pool for compressing blocks (the plain file and its compressed
+        # variants each), so the number of threads stays bounded. It has to
+        # be distinct from the outer pool, or tasks waiting on compression
+        # could starve it.
+        files_per_obj = 1 + len(self._Packages_Compression_Types)
+        compressors = futures.ThreadPoolExecutor(
+            max_workers=utils.max_workers(files_per_obj * len(objs)))
+        # The blocks of all the Packages.gz files are compressed on a third
+        # pool: the compressors wait on them
+        gzip_blocks = futures.ThreadPoolExecutor(
+            max_workers=utils.max_workers(
+                self._GZIP_MAX_THREADS * len(objs)))
+        # When there are more of them than workers, starting with the
+        # largest ones lets the small ones fill in the gaps at the end
+        order = sorted(range(len(objs)),
+                       key=lambda i: -objs[i].estimated_package_count())
+        with compressors, gzip_blocks, futures.ThreadPoolExecutor(
+                max_workers=utils.max_workers(len(objs))) as executor:
+            futs = dict(
+                (i, executor.submit(objs[i].write_packages, base_path,
+                                    release_dir, executor=compressors,
+                                    gzip_executor=gzip_blocks,
+                                    hash_algorithms=self.hash_algorithms,
+                                    by_hash=self.acquire_by_hash))
+                for i in order)
+            # Merge the results in order, so the Release file is stable
+            for i in range(len(objs)):
+                for k, vlist in futs[i].result().items():
+                    all_checksums[k].extend(vlist)
+        # Add the fields in a fixed order too (MD5Sum, SHA1, SHA256, like
+        # apt's own), rather than whichever order the hashes came in
+        for k in sorted(all_checksums):
+            self.release[k] = all_checksums[k]
+        if self.acquire_by_hash:
+            self.release['Acquire-By-Hash'] = 'yes'
         self.write_release(base_path)
 
     def write_release(self, base_path):
-        self.release.pop('Date', None)
-        self.set_date()
+        # Replacing the value in place keeps Date ahead of the checksums,
+        # where apt's own Release files have it
+        self.set_date(force=True)
 
         path = self.release_path(base_path)
         utils.makedirs(os.path.dirname(path))
-        self.release.dump(open(path, "wb"))
+        _dump_paragraph(self.release, path)
 
     def dists_dir(self):
         return os.path.join(self.base_path, 'dists',
@@ -198,61 +311,178 @@ class AptRepoMeta(object):
 
     @classmethod
     def WritePackages(cls, base_path, release_dir,
-                      relative_path_fname, packages):
+                      relative_path_fname, packages, executor=None,
+                      compression_types=None, hash_algorithms=None,
+                      by_hash=False, gzip_executor=None):
         """
         packages: iterator of objects with a dump() method (debpkg.DebPkg or
         deb822.Packages)
+        executor: optional concurrent.futures.Executor to compress with;
+        if not specified, one is created for this call
+        compression_types: compressed variants to write next to the plain
+        file (a subset of _Compression_Types); defaults to
+        _Packages_Compression_Types
+        hash_algorithms: digests to compute (a subset of the keys of
+        _Hash_Algorithms); defaults to all of them
+        by_hash: if True, also link the files under by-hash/SHA256/ in
+        their directory (sha256 has to be one of the hash_algorithms)
+        gzip_executor: optional concurrent.futures.Executor to compress the
+        blocks of the gz file with, distinct from executor; if not
+        specified, the gz file compresses them on threads of its own
         """
-        short_names = [relative_path_fname,
-                       relative_path_fname + '.gz',
-                       relative_path_fname + '.bz2',
-                       ]
+        if compression_types is None:
+            compression_types = cls._Packages_Compression_Types
+        unsupported = set(compression_types).difference(
+            cls._Compression_Types)
+        if unsupported:
+            raise ValueError("Unsupported compression types: %s" % (
+                ', '.join(sorted(unsupported))))
+        HA = cls._Hash_Algorithms
+        if hash_algorithms is not None:
+            unsupported = set(hash_algorithms).difference(HA)
+            if unsupported:
+                raise ValueError("Unsupported hash algorithms: %s" % (
+                    ', '.join(sorted(unsupported))))
+            HA = dict((k, v) for k, v in HA.items() if k in hash_algorithms)
+        if by_hash and 'sha256' not in HA:
+            raise ValueError("by-hash publishing requires sha256")
+        extensions = [None] + list(compression_types)
+        short_names = [relative_path_fname] + [
+            '{}.{}'.format(relative_path_fname, x) for x in extensions[1:]]
         pkg_files = [os.path.join(release_dir, x) for x in short_names]
         utils.makedirs(os.path.dirname(pkg_files[0]))
 
-        pkg_plain, pkg_gz, pkg_bz2 = pkg_files
+        pkg_plain = pkg_files[0]
+        # Write the plain and compressed files in one pass, hashing the
+        # bytes as they go to disk. The compressors work on each block in
+        # parallel. The files are renamed into place once complete: if the
+        # packages are being read from the existing file, the iterator keeps
+        # working on the replaced one.
+        own_executor = executor is None
+        if own_executor:
+            executor = futures.ThreadPoolExecutor(
+                max_workers=utils.max_workers(len(extensions)))
+        writer = compressr.MultiWriter(
+            pkg_plain, extensions, algorithms=HA, executor=executor,
+            compresslevels=dict(gz=cls._GZIP_LEVEL, bz2=cls._BZ2_LEVEL,
+                                xz=cls._XZ_PRESET),
+            gzip_threads=utils.max_workers(cls._GZIP_MAX_THREADS),
+            gzip_executor=gzip_executor)
+        # deb822 writes one field at a time; batch the serialized packages
+        # so the compressors and hashers see large blocks
+        buf = io.BytesIO()
         try:
-            # This will make sure the iterator will continue to work if one
-            # exists, because it will point to a deleted file
+            # Packages are separated by blank lines: dump the first one
+            # outside of the loop, so the loop does not have to test for it
+            packages = iter(packages)
+            for pkg in itertools.islice(packages, 1):
+                pkg.dump(buf)
+            for pkg in packages:
+                buf.write(b"\n")
+                pkg.dump(buf)
+                if buf.tell() >= cls._Packages_Block_Size:
+                    cls._flush_buffer(writer, buf)
+            cls._flush_buffer(writer, buf)
+        except Exception:
+            writer.discard()
+            raise
+        else:
+            writer.close()
+        finally:
+            if own_executor:
+                executor.shutdown()
+        # Variants written by an earlier run with other compression types
+        # would no longer match the Release file
+        for ext in cls._Compression_Types:
+            if ext in compression_types:
+                continue
             try:
-                os.unlink(pkg_plain)
+                os.unlink('{}.{}'.format(pkg_plain, ext))
             except OSError as e:
-                if e.errno != 2:
+                if e.errno != errno.ENOENT:
                     raise
-            shutil.rmtree(pkg_plain, ignore_errors=True)
-            with open(pkg_plain, 'wb') as pfh:
-                first = True
-                for pkg in packages:
-                    if first:
-                        first = False
-                    else:
-                        pfh.write(b"\n")
-                    pkg.dump(pfh)
-        except IOError:
-            raise
-        try:
-            with open(pkg_plain, 'rb') as fhi:
-                with gzip.open(pkg_gz, 'wb') as fhout:
-                    shutil.copyfileobj(fhi, fhout)
-                fhi.seek(0)
-                with bz2.BZ2File(pkg_bz2, 'wb', compresslevel=9) as fhout:
-                    shutil.copyfileobj(fhi, fhout)
-        except IOError:
-            raise
 
-        HA = cls._Hash_Algorithms
         checksums = dict()
-        for relative_fname in short_names:
-            src = os.path.join(release_dir, relative_fname)
-            hashes = hash_file(src, algs=HA)
-            size = str(os.stat(src).st_size)
-            common = dict(name=relative_fname, size=size)
+        by_hash_digests = set()
+        for relative_fname, src in zip(short_names, pkg_files):
+            hashes = writer.hashers[src]
+            if by_hash:
+                cls._link_by_hash(src, hashes.digests['sha256'])
+                by_hash_digests.add(hashes.digests['sha256'])
+            common = dict(name=relative_fname, size=str(hashes.size))
             for alg_name, (key_name, outer_name) in HA.items():
                 info = dict(common)
-                info[key_name] = hashes[alg_name]
+                info[key_name] = hashes.digests[alg_name]
                 checksums.setdefault(outer_name, []).append(info)
+        if by_hash:
+            # Each run links one file per variant
+            cls._prune_by_hash(
+                cls._by_hash_dir(pkg_plain), by_hash_digests,
+                cls._BY_HASH_KEEP * len(pkg_files))
         return short_names, checksums
 
+    @staticmethod
+    def _by_hash_dir(path):
+        return os.path.join(os.path.dirname(path), 'by-hash', 'SHA256')
+
+    @classmethod
+    def _link_by_hash(cls, path, digest):
+        dirname = cls._by_hash_dir(path)
+        utils.makedirs(dirname)
+        link = os.path.join(dirname, digest)
+        if os.path.lexists(link):
+            # Same contents as a previous run
+            return
+        try:
+            # A hard link costs no space, and keeps the contents around
+            # after the file itself is replaced
+            os.link(path, link)
+        except OSError:
+            # Not a symlink, which would follow the file once replaced
+            utils.copyfile(path, link)
+
+    @classmethod
+    def _prune_by_hash(cls, dirname, current, keep):
+        """
+        Remove the files in a by-hash directory that are not in current,
+        except for the keep most recent ones. Links share the modification
+        time of the file they were made from, so the most recent ones are
+        the latest generations.
+        """
+        entries = []
+        for name in os.listdir(dirname):
+            if name in current:
+                continue
+            path = os.path.join(dirname, name)
+            try:
+                entries.append((os.lstat(path).st_mtime, name, path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        entries.sort(reverse=True)
+        for _, _, path in entries[keep:]:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    @classmethod
+    def _flush_buffer(cls, writer, buf):
+        if hasattr(buf, 'getbuffer'):
+            # Hand the compressors and hashers a view of the buffer, instead
+            # of a copy of its contents
+            view = buf.getbuffer()
+            try:
+                writer.write(view)
+            finally:
+                # The buffer cannot be resized while a view is exported
+                view.release()
+        else:
+            writer.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+
     def create_Packages_download_requests(self, base_path):
         """
         Iterate over the release file and create a list of download request
@@ -268,11 +498,9 @@ class AptRepoMeta(object):
             fobj = path_to_fobj[preferred_filename]
             caobj = self.get_component_arch_binary(component, arch)
             dl_meta = dict(fobj, component=component, architecture=arch)
-            dest = os.path.join(base_path, caobj.relative_path('Packages'))
-            # Remove trailing Packages, replace with the actual file name from
-            # upstream
-            dest = os.path.join(os.path.dirname(dest),
-                                os.path.basename(preferred_filename))
+            # Use the actual file name from upstream
+            dest = os.path.join(base_path, caobj.relative_path(
+                os.path.basename(preferred_filename)))
             utils.makedirs(os.path.dirname(dest))
             dl_reqs.append(utils.DownloadRequest(
                 os.path.join(self.upstream_url, preferred_filename),
@@ -289,31 +517,103 @@ class AptRepoMeta(object):
         dl_reqs is a list of utils.DownloadRequest objects
         """
         cmprsr = compressr.Opener()
-        # Validate downloads
-        for dl in dl_reqs:
-            algorithms = []
-            for alg_name, (key_name, _) in self._Hash_Algorithms.items():
-                if key_name in dl.data:
-                    algorithms.append(alg_name)
-                    break
-
-            digests = hash_file(dl.destination, algorithms)
+        dl_reqs = list(dl_reqs)
+        caobjs = [self.get_component_arch_binary(
+            dl.data['component'], dl.data['architecture']) for dl in dl_reqs]
+        # Downloads are independent of each other, and hashing and
+        # decompressing them release the GIL
+        with futures.ThreadPoolExecutor(
+                max_workers=utils.max_workers(len(dl_reqs))) as executor:
+            futs = [executor.submit(self._validate_download, cmprsr, dl)
+                    for dl in dl_reqs]
+        results = []
+        error = None
+        for fut in futs:
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                if error is None:
+                    error = e
+        # The compressed downloads are only removed once all of them are
+        # valid; otherwise, the files decompressed from them are, and the
+        # directory is left as it was
+        if error is not None:
+            for fobj, compressed in results:
+                fobj.close()
+                if compressed is not None:
+                    os.unlink(fobj.name)
+            raise error
+        for caobj, (fobj, compressed) in zip(caobjs, results):
+            if compressed is not None:
+                os.unlink(compressed)
+            caobj.packages_file = fobj
+        return self
+
+    @classmethod
+    def _validate_download(cls, opener, dl):
+        """
+        Validate a single download request. Returns its (uncompressed)
+        contents as a file object, and the path of the compressed download
+        it was decompressed from, or None. That file is left in place.
+        """
+        algorithms = []
+        for alg_name, (key_name, _) in cls._Hash_Algorithms.items():
+            if key_name in dl.data:
+                algorithms.append(alg_name)
+                break
+
+        # The Release file records sizes too; checking them first avoids
+        # hashing a truncated download
+        size = dl.data.get('size')
+        if size is not None:
+            if os.stat(dl.destination).st_size != int(size):
+                raise Exception("Size did not match")
+
+        dest, ext = os.path.splitext(dl.destination)
+        if ext.lstrip('.') in cls._Compression_Types:
+            # Decompress into a file opened for reading too, and rewind
+            # it, rather than reopening it
+            fobj = open(dest, "w+b")
+            digests, error = cls._decompress(
+                opener, dl.destination, fobj, algorithms)
             if digests[alg_name] != dl.data[key_name]:
+                fobj.close()
+                os.unlink(dest)
                 raise Exception("Checksum did not match")
+            if error is not None:
+                fobj.close()
+                os.unlink(dest)
+                raise error
+            fobj.seek(0)
+            return fobj, dl.destination
+        digests = hash_file(dl.destination, algorithms)
+        if digests[alg_name] != dl.data[key_name]:
+            raise Exception("Checksum did not match")
+        return open(dl.destination, "rb"), None
 
-            component = dl.data['component']
-            arch = dl.data['architecture']
-            caobj = self.get_component_arch_binary(component, arch)
-            ext = os.path.splitext(dl.destination)[1].lstrip('.')
-            if ext in self._Compression_Types:
-                dest = dl.destination[:-len(ext) - 1]
-                shutil.copyfileobj(cmprsr.open(dl.destination, "rb"),
-                                   open(dest, "wb"))
-                os.unlink(dl.destination)
-            else:
-                dest = dl.destination
-            caobj.packages_file = open(dest, "rb")
-        return self
+    @classmethod
+    def _decompress(cls, opener, path, fobj, algorithms):
+        """
+        Decompress path into fobj, hashing the compressed data as it is
+        read, instead of reading it once more just to verify it.
+        Returns the digests of path, and the error decompressing it if any:
+        a corrupted download should be reported as such, rather than as
+        whatever the decompressor failed on.
+        """
+        error = None
+        with open(path, "rb") as raw:
+            reader = HashingReader(raw, algorithms=algorithms)
+            try:
+                with opener.open(path, "rb", fileobj=reader) as fin:
+                    # The default buffer size (16-64KiB) means many more
+                    # calls into the decompressor and hashers
+                    shutil.copyfileobj(fin, fobj, HashFile.BLOCKSIZE)
+            except Exception as e:
+                error = e
+            # Decompressors may stop short of the end of the file
+            while reader.read(HashFile.BLOCKSIZE):
+                pass
+        return reader.digests, error
 
 
 class ComponentArchBinary(object):
@@ -355,6 +655,24 @@ class ComponentArchBinary(object):
         self._packages_file = value
         self._packages_file.seek(0)
 
+    # Rough size of a package's stanza in a Packages file
+    _Packages_Stanza_Size = 1024
+
+    def estimated_package_count(self):
+        """
+        Number of packages, estimated from the size of the Packages file
+        when they have not been loaded.
+        """
+        if self._packages is not None:
+            return len(self._packages)
+        if self._packages_file is None:
+            return 0
+        try:
+            size = os.fstat(self._packages_file.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            return 0
+        return size // self._Packages_Stanza_Size
+
     def iter_packages(self):
         if self._packages is not None:
             return iter(self._packages)
@@ -365,20 +683,25 @@ class ComponentArchBinary(object):
 
     def load_packages(self, base_path):
         pkgs_relative_path = self.relative_path('Packages')
+        # deb822 decodes each paragraph itself; a text file would decode
+        # all of it first, with whatever the locale's encoding is
         self._packages_file = open(
-            os.path.join(base_path, pkgs_relative_path))
+            os.path.join(base_path, pkgs_relative_path), "rb")
+
+    # Paths relative to the repository root use / as the separator, like
+    # the Release and Packages files that refer to them
 
     def relative_path(self, fname):
-        return os.path.join(
-            'dists', self.dist, self.release['Component'],
-            'binary-{}'.format(self.release['Architecture']), fname)
+        return 'dists/{}/{}/binary-{}/{}'.format(
+            self.dist, self.release['Component'],
+            self.release['Architecture'], fname)
 
     def release_path(self, base_path):
         return os.path.join(base_path, self.relative_path('Release'))
 
     @property
     def pool_relative_path(self):
-        return os.path.join('pool', self.release['Component'])
+        return 'pool/' + self.release['Component']
 
     def pool_path(self, base_path):
         return os.path.join(base_path, self.pool_relative_path)
@@ -386,20 +709,31 @@ class ComponentArchBinary(object):
     def write_release(self, base_path):
         path = self.release_path(base_path)
         utils.makedirs(os.path.dirname(path))
-        self.release.dump(open(path, "wb"))
+        _dump_paragraph(self.release, path)
 
-    def write_packages(self, base_path, release_dir):
-        pkgs_relative_path = os.path.join(
-            self.component, 'binary-{}'.format(self.architecture), 'Packages')
+    def write_packages(self, base_path, release_dir, executor=None,
+                       hash_algorithms=None, by_hash=False,
+                       gzip_executor=None):
+        pkgs_relative_path = '{}/binary-{}/Packages'.format(
+            self.component, self.architecture)
         pkg_files, checksums = AptRepoMeta.WritePackages(
-            base_path, release_dir, pkgs_relative_path, self.iter_packages())
+            base_path, release_dir, pkgs_relative_path, self.iter_packages(),
+            executor=executor, hash_algorithms=hash_algorithms,
+            by_hash=by_hash, gzip_executor=gzip_executor)
         return checksums
 
 
 class AptRepo(object):
 
     def __init__(self, path, metadata=None, gpg_sign_options=None,
-                 repo_name=None):
+                 repo_name=None, hash_cache=None):
+        """
+        hash_cache: optional hashcache.HashCache, used to avoid hashing
+        package files that have not changed since a previous run. If not
+        specified, an in-memory cache still avoids hashing a file more than
+        once in this object's lifetime (for instance, when the same
+        Architecture: all package is added for several architectures).
+        """
         self.base_path = path
         if gpg_sign_options is not None:
             if not isinstance(gpg_sign_options, signer.SignOptions):
@@ -411,6 +745,9 @@ class AptRepo(object):
             metadata = AptRepoMeta()
         self.metadata = metadata
         self._repo_name = repo_name
+        if hash_cache is None:
+            hash_cache = HashCache()
+        self.hash_cache = hash_cache
 
     @property
     def repo_name(self):
@@ -444,26 +781,60 @@ class AptRepo(object):
         utils.makedirs(dst_dir)
         rel_path = component.pool_relative_path
 
-        for filename in filenames:
-            sz = str(os.stat(filename).st_size)
-            pkg = debpkg.DebPkg.from_file(filename, Size=sz)
-            dst_path = os.path.join(dst_dir, pkg.filename)
-            pkg.relative_path = os.path.join(rel_path, pkg.filename)
+        # Hashing is the expensive part of reading a .deb and it releases
+        # the GIL, so hash all the files concurrently up front
+        filenames = list(filenames)
+        file_hashes = deb_hash_files(filenames, cache=self.hash_cache)
+        self.hash_cache.save()
+
+        def from_file(filename):
+            hashes, sz = file_hashes[filename]
+            return debpkg.DebPkg.from_file(filename, hashes=hashes,
+                                           Size=str(sz))
+
+        def add_package(item):
+            dst_path, filename = item
             self._add_package(filename, dst_path, with_symlinks=with_symlinks)
-            component.add_package(pkg)
+
+        # Parsing a .deb is mostly reading it and decompressing its control
+        # archive, both of which release the GIL. DebPkg objects cannot be
+        # pickled, so this uses threads rather than processes.
+        with futures.ThreadPoolExecutor(
+                max_workers=utils.max_workers(len(filenames))) as executor:
+            pkgs = list(executor.map(from_file, filenames))
+            # Destination path -> file to copy or link there. If several
+            # files have the same destination, the last one wins, as if
+            # they were added one after the other.
+            placements = dict()
+            for filename, pkg in zip(filenames, pkgs):
+                pkg_filename = pkg.filename
+                dst_path = os.path.join(dst_dir, pkg_filename)
+                pkg.relative_path = '{}/{}'.format(rel_path, pkg_filename)
+                placements[dst_path] = filename
+                component.add_package(pkg)
+            # Copies are I/O bound too
+            for _ in executor.map(add_package, placements.items()):
+                pass
 
         return component
 
     def _add_package(self, filename, destination, with_symlinks=False):
         if with_symlinks:
             log.debug("Symlinking %s -> %s", filename, destination)
-            if os.path.exists(destination):
-                log.debug("    Removing existing destination")
+            # Unlink unconditionally: saves a stat, and also removes
+            # dangling symlinks, which os.path.exists would not report
+            try:
                 os.unlink(destination)
+                log.debug("    Removed existing destination")
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
             os.symlink(filename, destination)
         else:
             log.debug("Copying %s -> %s", filename, destination)
-            shutil.copy(filename, destination)
+            # Only the contents are needed; copyfile skips the chmod, and
+            # reflinks or uses in-kernel copies where available
+            utils.copyfile(filename, destination)
 
     def create(self, files=None, with_symlinks=False, component=None,
                architecture=None):
@@ -501,15 +872,22 @@ class AptRepo(object):
         release_file = os.path.join(path, 'Release')
         # TODO Verify signatures
         # release_sig  = os.path.join(path, 'Release.gpg')
-        dest = tempfile.NamedTemporaryFile(delete=False).name
-        req = cls.make_download_request(
-            utils.DownloadRequest(release_file, dest, data=None))
+        fd, dest = tempfile.mkstemp(prefix='Release-')
+        os.close(fd)
         try:
-            cls.download([req])
-        except:  # noqa: E722
-            log.error('Failed to open %s', release_file, exc_info=True)
-            raise
-        meta = AptRepoMeta(release=open(dest, "rb"), upstream_url=path)
+            req = cls.make_download_request(
+                utils.DownloadRequest(release_file, dest, data=None))
+            try:
+                cls.download([req])
+            except:  # noqa: E722
+                log.error('Failed to open %s', release_file, exc_info=True)
+                raise
+            # AptRepoMeta parses the file itself; handing it a parsed
+            # Release would only have it copied
+            with open(dest, "rb") as fh:
+                meta = AptRepoMeta(release=fh, upstream_url=path)
+        finally:
+            os.unlink(dest)
         return cls(base_path, meta)
 
     @classmethod
@@ -524,7 +902,7 @@ class AptRepo(object):
 
 def create_repo(path, files, codename=None, components=None,
                 arches=None, desc=None, origin=None, label=None,
-                with_symlinks=False):
+                with_symlinks=False, hash_cache=None):
     if arches is not None:
         if isinstance(arches, string_types):
             arches = [x for x in arches.split() if x]
@@ -536,7 +914,7 @@ def create_repo(path, files, codename=None, components=None,
                            components=components,
                            architectures=arches,
                            description=desc)
-    repo = AptRepo(path, metadata=metadata)
+    repo = AptRepo(path, metadata=metadata, hash_cache=hash_cache)
     repo.create(files, with_symlinks=with_symlinks)
     return repo
 
@@ -26,9 +26,22 @@ from six.moves.reprlib import Repr
 from six.moves.urllib.parse import parse_qs, urlsplit, urlunsplit
 from six.moves.urllib.parse import urlparse, urlencode
 from six.moves.urllib.request import urlopen, urlretrieve
-from six.moves.urllib.error import HTTPError
+from six.moves.urllib.error import ContentTooShortError, HTTPError
 
 try:
     maketrans = str.maketrans
 except AttributeError:
     from string import maketrans
+
+try:
+    from os import replace as os_replace
+except ImportError:
+    # Python 2: os.rename() replaces an existing destination atomically on
+    # POSIX, but fails on Windows, where it has to be removed first
+    import os as _os
+    import sys as _sys
+
+    def os_replace(src, dst):
+        if _sys.platform == 'win32' and _os.path.exists(dst):
+            _os.remove(dst)
+        _os.rename(src, dst)
@@ -15,28 +15,64 @@
 #
 
 import bz2
-import gzip
+import collections
 import os
+import struct
 from collections import namedtuple
+from concurrent import futures
+
+from . import hasher
+from .compat import os_replace
 
 try:
     import lzma
 except ImportError:
     from backports import lzma
 
+try:
+    # ISA-L's igzip is API-compatible with gzip and several times faster
+    from isal import igzip as gzip
+    from isal import isal_zlib as zlib
+    from isal.isal_zlib import ISAL_BEST_COMPRESSION as GZIP_BEST_COMPRESSION
+    from isal.isal_zlib import (
+        ISAL_DEFAULT_COMPRESSION as GZIP_DEFAULT_COMPRESSION)
+except ImportError:
+    import gzip
+    import zlib
+    GZIP_BEST_COMPRESSION = 9
+    # Same as the gzip command line tool; much faster than 9, for files
+    # only marginally larger
+    GZIP_DEFAULT_COMPRESSION = 6
+
+
+# zlib's window size, plus 16 for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+try:
+    zlib.compressobj(zdict=b"\0")
+except TypeError:
+    # Python 2: no preset dictionaries, so no parallel compression
+    GZIP_PARALLEL = False
+else:
+    GZIP_PARALLEL = True
+
 
 Filename = namedtuple("Filename", "path base_name extension")
-_Opener = namedtuple("_Opener", "factory extensions args_read args_write")
+# level_arg: name of the factory's compression level argument
+_Opener = namedtuple("_Opener",
+                     "factory extensions args_read args_write level_arg")
 
 
 class Opener(object):
     _Decompressor_Factories = dict(
         gz=_Opener(gzip.open, extensions=['gz'], args_read=dict(),
-                   args_write=dict(compresslevel=9)),
+                   args_write=dict(compresslevel=GZIP_BEST_COMPRESSION),
+                   level_arg='compresslevel'),
         xz=_Opener(lzma.LZMAFile, extensions=['xz'],
-                   args_read=dict(), args_write=dict()),
+                   args_read=dict(), args_write=dict(), level_arg='preset'),
         bz2=_Opener(bz2.BZ2File, extensions=['bz2', 'bzip2'],
-                    args_read=dict(), args_write=dict()),
+                    args_read=dict(), args_write=dict(),
+                    level_arg='compresslevel'),
     )
 
     # Reverse lookup of decompressor by extension
@@ -53,42 +89,59 @@ class Opener(object):
             preferences = [x for x in preferences
                            if x in self._Decompressor_Factories]
         self.preferences = preferences
+        self._rank_dict = self._rank(preferences)
 
-    def best_choice(self, file_names):
-        """
-        Order file_names based on self.preferences
-        This allows one to prefer an xz file over a gz
-        """
+    @classmethod
+    def _rank(cls, preferences):
         rank_dict = dict()
-        for i, decompressor in enumerate(self.preferences):
-            dobj = self._Decompressor_Factories[decompressor]
+        for i, decompressor in enumerate(preferences):
+            dobj = cls._Decompressor_Factories[decompressor]
             for ext in dobj.extensions:
                 rank_dict[ext] = i
         # No extension - least preferred
         rank_dict[None] = 1000
+        return rank_dict
 
-        objs = dict()
+    def best_choice(self, file_names):
+        """
+        Order file_names based on self.preferences
+        This allows one to prefer an xz file over a gz
+        """
+        rank_dict = self._rank_dict
+        # Keep the best ranked file for each base name as they come, rather
+        # than collecting all candidates to pick from afterwards. On a tie
+        # (foo.bz2 and foo.bzip2) the first one wins.
+        best = dict()
         for fname in file_names:
             f = self._File(fname)
-            if f.extension not in rank_dict:
+            rank = rank_dict.get(f.extension)
+            if rank is None:
                 continue
-            objs.setdefault(f.base_name, set()).add(f)
-        ret = []
-        for _, objs in sorted(objs.items()):
-            obj = min(objs, key=lambda x: rank_dict[x.extension])
-            ret.append(obj.path)
-        return ret
-
-    def open(self, file_name, mode="rb", uncompressed=False):
+            current = best.get(f.base_name)
+            if current is None or rank < current[0]:
+                best[f.base_name] = (rank, f.path)
+        return [path for _, (_, path) in sorted(best.items())]
+
+    def open(self, file_name, mode="rb", uncompressed=False, fileobj=None,
+             compresslevel=None):
         """
         If uncompressed is True, the file is opened in uncompressed mode,
         regardless of its extension.
 
         This is useful if the file has an extension already (like foo.xml) and
         we don't want to treat the extension as a compression indicator.
+
+        If fileobj is specified, the (de)compressor wraps it instead of
+        opening file_name, which is then only used to pick the algorithm.
+        Closing the returned object does not close fileobj.
+
+        compresslevel, if specified, overrides the default compression level
+        when writing (the preset, for xz).
         """
         f = self._File(file_name)
         if uncompressed or f.extension is None:
+            if fileobj is not None:
+                return fileobj
             return open(file_name, mode)
         dname = self._Extension_to_decompressor.get(
             f.extension, f.extension)
@@ -99,6 +152,11 @@ class Opener(object):
             opts = d.args_read
         else:
             opts = d.args_write
+            if compresslevel is not None:
+                opts = dict(opts)
+                opts[d.level_arg] = compresslevel
+        if fileobj is not None:
+            file_name = fileobj
         return d.factory(file_name, mode, **opts)
 
     @classmethod
@@ -115,33 +173,282 @@ class Opener(object):
         return Filename(fpath, bname, ext)
 
 
+class GzipWriter(object):
+    """
+    Write-only gzip stream on top of fileobj, driving zlib directly instead
+    of going through gzip.GzipFile. The header carries no file name or
+    timestamp, so identical contents compress to identical files.
+    Closing it does not close fileobj.
+
+    If threads is specified, the data is compressed the way pigz does it:
+    cut in fixed size blocks, compressed on up to that many threads with
+    the end of the previous block as a preset dictionary, and flushed to a
+    byte boundary so the pieces can be concatenated into a single deflate
+    stream. The output is a regular gzip file, a fraction of a percent
+    larger, and the same whatever the number of threads.
+
+    If executor is specified as well, the blocks are compressed on it
+    instead of on threads of this object's own, and threads only bounds
+    the number of blocks in flight. Several writers can then share one
+    pool. Compressing a block never waits on anything, so the executor can
+    be shared with the threads writing to the GzipWriters, but not with
+    tasks that wait on them.
+    """
+    # Same as pigz
+    BLOCK_SIZE = 1 << 17
+    DICT_SIZE = 1 << 15
+
+    def __init__(self, fileobj, compresslevel=GZIP_DEFAULT_COMPRESSION,
+                 threads=None, executor=None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads if GZIP_PARALLEL else None
+        if self.threads is not None:
+            self._compressor = None
+            self._pending = b""
+            self._dict = None
+            self._crc = zlib.crc32(b"")
+            self._size = 0
+            self._futures = collections.deque()
+            # Unless one is specified, created along with the first block,
+            # so small files do not start any threads
+            self._executor = executor
+            self._own_executor = executor is None
+            self._header_written = False
+        else:
+            self._compressor = zlib.compressobj(
+                compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        self._closed = False
+
+    def write(self, data):
+        if self._compressor is not None:
+            out = self._compressor.compress(data)
+            if out:
+                self.fileobj.write(out)
+            return len(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        pending = self._pending + bytes(data)
+        offset = 0
+        while len(pending) - offset >= self.BLOCK_SIZE:
+            self._submit(pending[offset:offset + self.BLOCK_SIZE])
+            offset += self.BLOCK_SIZE
+        self._pending = pending[offset:]
+        return len(data)
+
+    def _submit(self, block):
+        zdict = self._dict
+        self._dict = block[-self.DICT_SIZE:]
+        if self.threads <= 1 and self._own_executor:
+            self._write_out(
+                self._compress_block(block, zdict, self.compresslevel))
+            return
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=self.threads)
+        self._futures.append(self._executor.submit(
+            self._compress_block, block, zdict, self.compresslevel))
+        # Bound the memory held by blocks in flight
+        while len(self._futures) > 2 * max(self.threads, 1):
+            self._write_out(self._futures.popleft().result())
+
+    @staticmethod
+    def _raw_compressor(compresslevel, zdict):
+        # Raw deflate: the gzip header and trailer are written separately
+        kwargs = dict(level=compresslevel, method=zlib.DEFLATED,
+                      wbits=-zlib.MAX_WBITS)
+        if zdict:
+            kwargs['zdict'] = zdict
+        return zlib.compressobj(**kwargs)
+
+    @classmethod
+    def _compress_block(cls, block, zdict, compresslevel):
+        compressor = cls._raw_compressor(compresslevel, zdict)
+        return compressor.compress(block) + compressor.flush(
+            zlib.Z_SYNC_FLUSH)
+
+    def _write_out(self, data):
+        if not self._header_written:
+            self.fileobj.write(self._gzip_header())
+            self._header_written = True
+        self.fileobj.write(data)
+
+    def _gzip_header(self):
+        # The header the library itself writes for this level: no name, no
+        # timestamp, and its own extra flags and OS byte (zlib and ISA-L
+        # have different ranges of levels, and fill them differently)
+        compressor = zlib.compressobj(
+            self.compresslevel, zlib.DEFLATED, GZIP_WBITS)
+        return (compressor.compress(b"") + compressor.flush())[:10]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._compressor is not None:
+            self.fileobj.write(self._compressor.flush())
+            self._compressor = None
+            return
+        try:
+            # The last block may be empty; it still carries the final-block
+            # marker
+            last = self._pending
+            self._pending = b""
+            while self._futures:
+                self._write_out(self._futures.popleft().result())
+            compressor = self._raw_compressor(self.compresslevel, self._dict)
+            self._write_out(compressor.compress(last) + compressor.flush())
+            self.fileobj.write(struct.pack(
+                "<II", self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            if self._own_executor and self._executor is not None:
+                self._executor.shutdown()
+
+
 class MultiWriter(object):
-    def __init__(self, fpath, extensions, opener=None):
+    """
+    Write the same stream to fpath and its compressed variants.
+
+    If algorithms is specified, the bytes that end up in each file are
+    hashed as they are written; after close(), hashers maps each file name
+    to an object with digests and size attributes.
+
+    If executor (a concurrent.futures.Executor) is specified, each block is
+    written to all the files concurrently. zlib and bz2 release the GIL
+    while compressing, so with large blocks the compressors run in
+    parallel.
+
+    compresslevels optionally maps extensions to compression levels.
+
+    gzip_threads, if specified, is passed on to GzipWriter: gzip files are
+    then compressed in blocks, on that many threads. If gzip_executor is
+    specified as well, the blocks are compressed on it (see GzipWriter);
+    it must not be executor.
+
+    The files are written under temporary names, and renamed into place by
+    close(). Readers never see partially written files, and keep reading
+    the previous contents if they had them open. discard() removes the
+    temporary files instead.
+    """
+    # Below this size, handing a block off to threads costs more than
+    # compressing it
+    PARALLEL_MIN_SIZE = 1 << 16
+    # Compressors hand their output over in many small pieces; a larger
+    # buffer on the underlying files saves write() calls
+    BUFFER_SIZE = 1 << 17
+
+    def __init__(self, fpath, extensions, opener=None, algorithms=None,
+                 executor=None, compresslevels=None, gzip_threads=None,
+                 gzip_executor=None):
         self.fpath = fpath
+        self.executor = executor
+        self.gzip_threads = gzip_threads
+        self.gzip_executor = gzip_executor
+        self.compresslevels = compresslevels or dict()
         if opener is None:
             opener = Opener()
         self.opener = opener
+        self.algorithms = algorithms
         supported_extensions = [
             x for x in extensions
             if x in opener._Extension_to_decompressor]
         self.file_names = ["{}.{}".format(fpath, ext)
                            for ext in supported_extensions]
+        self._compresslevels = dict(
+            (fname, self.compresslevels.get(ext))
+            for fname, ext in zip(self.file_names, supported_extensions))
+        self._gzip_file_names = set(
+            fname for fname, ext in zip(self.file_names, supported_extensions)
+            if opener._Extension_to_decompressor[ext] == 'gz')
         if None in extensions or '' in extensions:
             self.file_names.append(fpath)
+        self._tmp_file_names = [self._tmp_name(x) for x in self.file_names]
         self.reset()
 
+    @staticmethod
+    def _tmp_name(fname):
+        dirname, basename = os.path.split(fname)
+        return os.path.join(dirname, ".{}.tmp".format(basename))
+
     def reset(self):
         self.file_objs = []
-        for fname in self.file_names:
+        self._raw_file_objs = []
+        self.hashers = dict()
+        for fname, tmp_name in zip(self.file_names, self._tmp_file_names):
             uncompressed = (fname == self.fpath)
+            compresslevel = self._compresslevels.get(fname)
+            fileobj = open(tmp_name, "wb", self.BUFFER_SIZE)
+            if self.algorithms is not None:
+                fileobj = hasher.HashingWriter(
+                    fileobj, algorithms=self.algorithms)
+                self.hashers[fname] = fileobj
+            self._raw_file_objs.append(fileobj)
+            if fname in self._gzip_file_names:
+                if compresslevel is None:
+                    # Same default as Opener
+                    compresslevel = GZIP_BEST_COMPRESSION
+                self.file_objs.append(GzipWriter(
+                    fileobj, compresslevel, threads=self.gzip_threads,
+                    executor=self.gzip_executor))
+                continue
             self.file_objs.append(
-                self.opener.open(fname, "wb", uncompressed=uncompressed))
+                self.opener.open(fname, "wb", uncompressed=uncompressed,
+                                 fileobj=fileobj,
+                                 compresslevel=compresslevel))
 
     def write(self, block):
+        parallel = self.executor is not None and len(self.file_objs) > 1
+        if parallel and len(block) >= self.PARALLEL_MIN_SIZE:
+            # The calling thread writes the first file itself rather than
+            # wait idle for the others
+            futs = [self.executor.submit(x.write, block)
+                    for x in self.file_objs[1:]]
+            try:
+                self.file_objs[0].write(block)
+            finally:
+                # Wait for all the writes before returning, so a file object
+                # is never written from two threads at once, and block is
+                # not in use any more
+                futures.wait(futs)
+            for fut in futs:
+                # Re-raise errors
+                fut.result()
+            return
         for fobj in self.file_objs:
             fobj.write(block)
 
+    def _close(self):
+        try:
+            for fobj in self.file_objs:
+                fobj.close()
+        finally:
+            # Compressors do not close file objects they did not open
+            for fobj in self._raw_file_objs:
+                fobj.close()
+            self.file_objs = []
+            self._raw_file_objs = []
+
     def close(self):
-        for fobj in self.file_objs:
-            fobj.close()
-        self.file_objs = []
+        if not self.file_objs:
+            return
+        try:
+            self._close()
+        except Exception:
+            self._remove_tmp_files()
+            raise
+        for tmp_name, fname in zip(self._tmp_file_names, self.file_names):
+            # Unlike os.rename(), replaces existing files on Windows too
+            os_replace(tmp_name, fname)
+
+    def discard(self):
+        try:
+            self._close()
+        finally:
+            self._remove_tmp_files()
+
+    def _remove_tmp_files(self):
+        for tmp_name in self._tmp_file_names:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
@@ -31,18 +31,14 @@ from __future__ import unicode_literals
 import logging
 import six
 import sys
-import inspect
 from io import StringIO
 
-from functools import total_ordering
-
 log = logging.getLogger(__name__)
 
 try:
     from debian import debfile
     from debian import deb822
     from debian.debian_support import Version
-    from debian.debian_support import version_compare
 except Exception:
     log.error(
         "[ERROR] Failed to import debian\n"
@@ -77,14 +73,14 @@ class DebPkgFiles(UserList):
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return sorted(self.__dict__) == sorted(other.__dict__)
+            # The files of a package are a set; like __str__, ignore the
+            # order they were listed in
+            return sorted(self.data) == sorted(other.data)
         elif isinstance(other, (list, tuple)):
             return self.data == other
         return False
 
     def __ne__(self, other):
-        if isinstance(other, self.__class__):
-            return not self.__eq__(other)
         return not self == other
 
 
@@ -164,35 +160,64 @@ class DebPkgRequires(object):
 
     __slots__ = ('depends', 'pre_depends', 'recommends',
                  'suggests', 'breaks', 'conflicts', 'provides', 'replaces',
-                 'enhances')
+                 'enhances', '_raw')
 
-    _defaults = dict((s, list()) for s in __slots__)
+    _defaults = dict((s, list()) for s in __slots__ if not s.startswith('_'))
 
     def __init__(self, **kwargs):
-        slots = self.__class__._all_slots()
-        for k in slots:
-            key = self._handle_key(k)
-            if key in kwargs:
-                val = self.parse(kwargs.get(key))
-            else:
-                val = self._defaults.get(k)
-            setattr(self, k, val)
+        # Only keep the raw values: parsing relations is costly, and most
+        # users only look at some of them. Each field is parsed the first
+        # time it is read (see __getattr__).
+        self._raw = dict((k, kwargs[key]) for k, key in self._slot_keys()
+                         if key in kwargs)
+
+    def __getattr__(self, name):
+        # Only called for slots that have not been set yet
+        if name not in self._all_slots():
+            raise AttributeError(name)
+        try:
+            raw = self._raw.pop(name)
+        except KeyError:
+            # A shallow copy is enough to not share the default list
+            # between instances
+            val = list(self._defaults[name])
+        else:
+            val = self.parse(raw)
+        setattr(self, name, val)
+        return val
 
     def __repr__(self):
         return 'DebPkgRequires(%s)' % self.relations
 
-    def _handle_key(self, k):
+    @staticmethod
+    def _handle_key(k):
         if '_' in k:
             return '-'.join([x.capitalize() for x in k.split('_')])
         return k.capitalize()
 
     @classmethod
     def _all_slots(cls):
-        slots = set()
-        for kls in inspect.getmro(cls):
-            slots.update(getattr(kls, '__slots__', []))
+        # Computed once per class (look in the class' own __dict__, so
+        # subclasses don't pick up their parent's cache)
+        slots = cls.__dict__.get('_all_slots_cache')
+        if slots is None:
+            slots = set()
+            for kls in cls.__mro__:
+                slots.update(getattr(kls, '__slots__', []))
+            # Private slots hold state, not relations
+            slots = frozenset(x for x in slots if not x.startswith('_'))
+            cls._all_slots_cache = slots
         return slots
 
+    @classmethod
+    def _slot_keys(cls):
+        # (slot, control field name) pairs, also computed once per class
+        keys = cls.__dict__.get('_slot_keys_cache')
+        if keys is None:
+            keys = tuple((k, cls._handle_key(k)) for k in cls._all_slots())
+            cls._slot_keys_cache = keys
+        return keys
+
     @property
     def relations(self):
         return dict((x, getattr(self, x)) for x in self._all_slots())
@@ -202,14 +227,13 @@ class DebPkgRequires(object):
         return deb822.PkgRelation.parse_relations(raw)
 
     def __str__(self):
-        s = ""
+        lines = []
         fmt = "%s : %s\n"
-        for k in self._all_slots():
-            key = self._handle_key(k)
+        for k, key in self._slot_keys():
             dep = getattr(self, k)
             if dep:
-                s += fmt % (key, deb822.PkgRelation.str(dep))
-        return s
+                lines.append(fmt % (key, deb822.PkgRelation.str(dep)))
+        return "".join(lines)
 
 
 class DebPkgScripts(object):
@@ -246,20 +270,24 @@ class DebPkgScripts(object):
         return self.prerm
 
 
-@total_ordering
 class DebPkg(object):
     """Represent a binary debian package"""
 
-    __slots__ = ("_c", "_h", "_md5", "_deps", "_version", "_scripts")
+    __slots__ = ("_c", "_h", "_md5", "_deps", "_version", "_scripts",
+                 "_scripts_args", "_stanza", "_nevra", "_hash", "_files")
     ENCODINGS = ["utf-8", "iso-8859-1"]
 
     def __init__(self, control, hashes, md5sums, scripts={}):
         if isinstance(control, dict):
             control = deb822.Deb822(control)
         self._c = control
-        self._deps = DebPkgRequires(**self._c)
+        # Relations and scripts are only built when asked for: parsing
+        # every relation field is costly, and most uses of a package only
+        # need its name, version and architecture
+        self._deps = None
         self._version = Version(self._c.get('Version'))
-        self._scripts = DebPkgScripts(**scripts)
+        self._scripts = None
+        self._scripts_args = scripts
         if isinstance(hashes, dict):
             hashes = deb822.Deb822(hashes)
         self._h = hashes
@@ -267,6 +295,10 @@ class DebPkg(object):
             self._md5 = md5sums
         else:
             self._md5 = DebPkgMD5sums(md5sums)
+        self._stanza = None
+        self._nevra = None
+        self._hash = None
+        self._files = None
 
     def __repr__(self):
         return 'DebPkg(%s)' % self.nevra
@@ -275,8 +307,16 @@ class DebPkg(object):
         return self.nevra
 
     def __hash__(self):
-        return hash((self.name, self.version.full_version, self.arch))
-
+        # Packages get hashed and compared over and over when sorted or
+        # put in sets; like nevra, this is computed once
+        if self._hash is None:
+            self._hash = hash(
+                (self.name, self._version.full_version, self.arch))
+        return self._hash
+
+    # Rich comparisons are defined directly rather than derived with
+    # functools.total_ordering, which would go through two comparisons for
+    # <=, > and >=
     def __eq__(self, other):
         try:
             return self.__cmp__(other) == 0
@@ -285,7 +325,7 @@ class DebPkg(object):
 
     def __ne__(self, other):
         try:
-            return not (self == other)
+            return self.__cmp__(other) != 0
         except (AttributeError, TypeError):
             return NotImplemented
 
@@ -295,17 +335,38 @@ class DebPkg(object):
         except (AttributeError, TypeError):
             return NotImplemented
 
+    def __le__(self, other):
+        try:
+            return self.__cmp__(other) <= 0
+        except (AttributeError, TypeError):
+            return NotImplemented
+
+    def __gt__(self, other):
+        try:
+            return self.__cmp__(other) > 0
+        except (AttributeError, TypeError):
+            return NotImplemented
+
+    def __ge__(self, other):
+        try:
+            return self.__cmp__(other) >= 0
+        except (AttributeError, TypeError):
+            return NotImplemented
+
     def __cmp__(self, other):
         if self is other:
             return 0
-        if self.version == other.version:
+        # Compare the parsed versions, instead of having version_compare()
+        # parse both version strings again
+        version, other_version = self._version, other._version
+        if version == other_version:
             if (self._c, self._h, self._md5) == (
                     other._c, other._h, other._md5):
                 return 0
             return -1
-        else:
-            return version_compare(
-                self.version.full_version, other.full_version)
+        if version < other_version:
+            return -1
+        return 1
 
     @property
     def package(self):
@@ -315,10 +376,16 @@ class DebPkg(object):
 
     @property
     def files(self):
-        return DebPkgFiles([x for x in self._md5.keys()])
+        # The names are collected from md5sums once; each call still gets
+        # its own list, since DebPkgFiles is mutable
+        if self._files is None:
+            self._files = tuple(self._md5)
+        return DebPkgFiles(list(self._files))
 
     @property
     def scripts(self):
+        if self._scripts is None:
+            self._scripts = DebPkgScripts(**self._scripts_args)
         return self._scripts
 
     @property
@@ -344,6 +411,7 @@ class DebPkg(object):
     @relative_path.setter
     def relative_path(self, value):
         self._c['Filename'] = value
+        self._stanza = None
 
     @property
     def name(self):
@@ -379,15 +447,29 @@ class DebPkg(object):
 
     @property
     def nevra(self):
-        return '_'.join([self.name, self._version.full_version, self.arch])
+        """
+        name_version_arch, as used in file names. It is computed once:
+        changes made directly to the control paragraph's Package or
+        Architecture afterwards are not picked up.
+        """
+        if self._nevra is None:
+            self._nevra = '_'.join(
+                [self.name, self._version.full_version, self.arch])
+        return self._nevra
+
+    @property
+    def _requires(self):
+        if self._deps is None:
+            self._deps = DebPkgRequires(**self._c)
+        return self._deps
 
     @property
     def depends(self):
-        return self._deps.depends
+        return self._requires.depends
 
     @property
     def dependencies(self):
-        return self._deps.relations
+        return self._requires.relations
 
     @property
     def md5sum(self):
@@ -406,16 +488,20 @@ class DebPkg(object):
         return deb_hash_file(path)
 
     @classmethod
-    def from_file(cls, path, **kwargs):
+    def from_file(cls, path, hashes=None, **kwargs):
         """
         Allows for fields (like Filename and Size) to be added or replaced
         using keyword arguments.
+
+        hashes can be passed in if already computed (see make_hashes), to
+        avoid reading the file a second time.
         """
         debpkg = debfile.DebFile(filename=path)
         md5sums = cls.read_md5sums(debpkg, path)
         control = debpkg.control.debcontrol().copy()
         scripts = debpkg.control.scripts()
-        hashes = cls.make_hashes(path)
+        if hashes is None:
+            hashes = cls.make_hashes(path)
         control.update(kwargs)
         return cls(control, hashes, md5sums, scripts=scripts)
 
@@ -433,5 +519,28 @@ class DebPkg(object):
         # Re-raise last exception if we ran out of encodings to try
         raise
 
+    @property
+    def packages_stanza(self):
+        """
+        The package's entry in a Packages file, as bytes.
+
+        It is computed once and reused, since the same package is written
+        to several Packages files (and their compressed variants). Setting
+        relative_path resets it; other changes made directly to control or
+        hashes are not picked up once it has been computed.
+        """
+        if self._stanza is None:
+            encoding = self.ENCODINGS[0]
+            if any(k in self._c for k in self._h):
+                data = self.package.dump()
+            else:
+                # Serialize the control and hashes paragraphs back to back,
+                # instead of building a merged copy of the package
+                data = self._c.dump() + self._h.dump()
+            self._stanza = data.encode(encoding)
+        return self._stanza
+
     def dump(self, path):
-        return self.package.dump(path)
+        if path is None:
+            return self.package.dump(path)
+        path.write(self.packages_stanza)
@@ -0,0 +1,121 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Cache of file digests, so unchanged files do not have to be hashed again.
+
+Entries are keyed on the absolute path of the file, and are invalidated
+when the size, the modification time or the inode of the file change (the
+latter catches files replaced by a rename, like cp -p or rsync -t do).
+'''
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import tempfile
+
+from . import utils
+from .compat import os_replace
+
+log = logging.getLogger(__name__)
+
+
+def _mtime_ns(stobj):
+    if hasattr(stobj, 'st_mtime_ns'):
+        return stobj.st_mtime_ns
+    return int(stobj.st_mtime * 1e9)
+
+
+class HashCache(object):
+    """
+    Digest cache, optionally persisted as JSON in path.
+
+    Example:
+      cache = HashCache('/var/cache/debpkgr/hashes.json')
+      digests, size = hasher.hash_files(paths, cache=cache)[path]
+      cache.save()
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = dict()
+        self._dirty = False
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def _stat_key(stobj):
+        return [stobj.st_size, _mtime_ns(stobj), stobj.st_ino]
+
+    def get(self, path, algorithms, stobj=None):
+        """
+        Return a dictionary of digests for path, or None if any of the
+        algorithms is not cached, or if the file changed.
+        """
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        if stobj is None:
+            stobj = os.stat(path)
+        if entry['stat'] != self._stat_key(stobj):
+            return None
+        digests = entry['digests']
+        if not all(x in digests for x in algorithms):
+            return None
+        return dict((x, digests[x]) for x in algorithms)
+
+    def put(self, path, digests, stobj):
+        """
+        Record digests for path. stobj should be the result of a stat taken
+        before hashing, so a file modified while being hashed is not cached
+        as unchanged.
+        """
+        key = os.path.abspath(path)
+        stat_key = self._stat_key(stobj)
+        entry = self._entries.get(key)
+        if entry is not None and entry['stat'] == stat_key:
+            entry['digests'].update(digests)
+        else:
+            self._entries[key] = dict(stat=stat_key, digests=dict(digests))
+        self._dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                self._entries = json.load(fh)
+        except (IOError, OSError, ValueError) as e:
+            log.debug("Not loading hash cache %s: %s", self.path, e)
+            self._entries = dict()
+        self._dirty = False
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        utils.makedirs(dirname)
+        # Write to a temporary file and rename it, so a concurrent reader
+        # never sees a partially written cache
+        fd, tmp = tempfile.mkstemp(prefix='.hashcache-', dir=dirname)
+        # json.dump() goes through the pure Python encoder and writes each
+        # token separately; serialize in one go instead
+        data = json.dumps(self._entries)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        os_replace(tmp, self.path)
+        self._dirty = False
@@ -19,9 +19,14 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import mmap
 import os
 import six
+import sys
 import hashlib
+from concurrent import futures
+
+from . import utils
 
 
 class Hasher(object):
@@ -39,6 +44,9 @@ class Hasher(object):
         self.hashers = dict([(x, getattr(hashlib, x)())
                              for x in self._available_algorithms()
                              if x in self.algorithms])
+        # update() runs for every block of every file being hashed; bind
+        # the methods once
+        self._updates = tuple(x.update for x in self.hashers.values())
         self._digests = None
 
     def update(self, data):
@@ -51,8 +59,8 @@ class Hasher(object):
             return
         # Invalidate computed digests
         self._digests = None
-        for hasher in self.hashers.values():
-            hasher.update(data)
+        for update in self._updates:
+            update(data)
 
     def _available_algorithms(self):
         if not hasattr(hashlib, 'algorithms_guaranteed'):
@@ -92,28 +100,155 @@ class HashString(Hasher):
         self.update(data)
 
 
+class HashingWriter(object):
+    """
+    File-like object that writes through to fileobj, hashing the data and
+    keeping track of its size along the way.
+    """
+
+    def __init__(self, fileobj, algorithms=None):
+        self.fileobj = fileobj
+        self.hasher = Hasher(algorithms=algorithms)
+        self.size = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    @property
+    def digests(self):
+        return self.hasher.digests
+
+
+class HashingReader(object):
+    """
+    File-like object that reads from fileobj, hashing the data and keeping
+    track of its size along the way.
+    """
+
+    def __init__(self, fileobj, algorithms=None):
+        self.fileobj = fileobj
+        self.hasher = Hasher(algorithms=algorithms)
+        self.size = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def readinto(self, buf):
+        count = self.fileobj.readinto(buf)
+        if count:
+            self.hasher.update(memoryview(buf)[:count])
+            self.size += count
+        return count
+
+    def close(self):
+        self.fileobj.close()
+
+    @property
+    def digests(self):
+        return self.hasher.digests
+
+
 class HashFile(object):
-    BLOCKSIZE = 65536
+    # Large reads amortize the per-update overhead over all the hashers;
+    # hashlib releases the GIL while digesting them
+    BLOCKSIZE = 1 << 20
+    # Files at least this large are hashed from a memory map, except on
+    # 32-bit platforms, where large maps can exhaust the address space
+    MMAP_MIN_SIZE = 1 << 20
+    USE_MMAP = sys.maxsize > 1 << 32
+    # Mapped files at least this large are run through each algorithm in
+    # its own thread, unless parallel is False (when the file is one of
+    # several hashed concurrently, and the CPUs are busy already)
+    PARALLEL_MIN_SIZE = 1 << 24
 
-    def __init__(self, path, algorithms=None):
+    def __init__(self, path, algorithms=None, parallel=True):
         self.path = path
+        self.parallel = parallel
         self.filename = os.path.basename(self.path)
         self.digest_path = '.'.join([self.path, 'chksums'])
         self.hasher = Hasher(algorithms=algorithms)
         self._digests = None
+        self._size = None
 
     @property
     def digests(self):
         if self._digests is None:
-            with open(self.path, 'rb') as fh:
-                while True:
-                    buf = fh.read(self.BLOCKSIZE)
-                    if not buf:
-                        break
-                    self.hasher.update(buf)
+            # All algorithms are updated from the same buffer, so the file
+            # is only read once. It is read in large blocks or mapped, so
+            # the buffering layer of a regular file object would only add a
+            # copy.
+            with open(self.path, 'rb', buffering=0) as fh:
+                self._size = os.fstat(fh.fileno()).st_size
+                hashers = list(self.hasher.hashers.values())
+                if len(hashers) == 1 and hasattr(hashlib, 'file_digest'):
+                    # Python 3.11+: let hashlib drive the read loop, without
+                    # holding the GIL
+                    _advise_sequential(fh)
+                    hashlib.file_digest(fh, lambda: hashers[0])
+                elif self.USE_MMAP and self._size >= self.MMAP_MIN_SIZE:
+                    # Each hasher walks the page cache directly, instead of
+                    # copies of it in Python buffers. Mapping a file has a
+                    # setup cost, so small files are read instead.
+                    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        if hasattr(mm, 'madvise'):
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+                        large = self._size >= self.PARALLEL_MIN_SIZE
+                        if self.parallel and large:
+                            self._update_parallel(hashers, mm)
+                        else:
+                            self.hasher.update(mm)
+                    finally:
+                        mm.close()
+                else:
+                    _advise_sequential(fh)
+                    # Read into the same buffer over and over
+                    buf = bytearray(min(self.BLOCKSIZE, self._size) or 1)
+                    view = memoryview(buf)
+                    while True:
+                        count = fh.readinto(buf)
+                        if not count:
+                            break
+                        self.hasher.update(view[:count])
             self._digests = self.hasher.digests
         return self._digests
 
+    @staticmethod
+    def _update_parallel(hashers, data):
+        # hashlib (OpenSSL) releases the GIL while hashing large buffers,
+        # so the algorithms can run on several cores at once
+        workers = utils.max_workers(len(hashers))
+        if workers < 2:
+            for hasher in hashers:
+                hasher.update(data)
+            return
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for fut in [executor.submit(x.update, data) for x in hashers]:
+                fut.result()
+
+    @property
+    def size(self):
+        if self._size is None:
+            self.digests
+        return self._size
+
     @property
     def digest_lines(self):
         '''
@@ -128,28 +263,101 @@ class HashFile(object):
 
     def write(self):
         with open(self.digest_path, 'w') as fh:
-            for line in sorted(self.digest_lines):
-                fh.write(line)
-                fh.write('\n')
+            fh.write(''.join(x + '\n' for x in sorted(self.digest_lines)))
         return self.digest_path
 
 # UTILS
 
 
+def _advise_sequential(fh):
+    # Let the kernel read ahead more aggressively
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
 def hash_file(path, algs=['md5', 'sha1', 'sha256']):
     hasher = HashFile(path, algorithms=algs)
     return hasher.digests
 
 
+def _hash_file_and_size(path, algs, parallel=True):
+    hasher = HashFile(path, algorithms=algs, parallel=parallel)
+    return hasher.digests, hasher.size
+
+
+def hash_files(paths, algs=['md5', 'sha1', 'sha256'], max_workers=None,
+               cache=None):
+    '''
+    Hash several files concurrently.
+    Returns a dictionary mapping each path to a (digests, size) tuple.
+
+    If cache (a hashcache.HashCache) is specified, files that did not change
+    since they were cached are not hashed again, and the cache is updated
+    with newly computed digests.
+    '''
+    ret = dict()
+    stats = dict()
+    todo = []
+    for path in paths:
+        if cache is not None:
+            # Resolve the cache key once: for a relative path, abspath()
+            # has to ask for the current directory
+            key = os.path.abspath(path)
+            stobj = os.stat(key)
+            stats[path] = (key, stobj)
+            digests = cache.get(key, algs, stobj=stobj)
+            if digests is not None:
+                ret[path] = (digests, stobj.st_size)
+                continue
+        todo.append(path)
+    if not todo:
+        return ret
+    if max_workers is None:
+        max_workers = utils.max_workers(len(todo))
+    # Files hashed side by side already keep the CPUs busy; running their
+    # algorithms on threads of their own would only add contention
+    parallel = max_workers < 2
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            _hash_file_and_size, todo, [algs] * len(todo),
+            [parallel] * len(todo))
+        ret.update(zip(todo, results))
+    if cache is not None:
+        for path in todo:
+            key, stobj = stats[path]
+            cache.put(key, ret[path][0], stobj)
+    return ret
+
+
+# Apt Package File uses different syntax
+DEB_HASH_TRANSLATION = dict(md5="MD5sum", sha1="SHA1", sha256="SHA256")
+
+
+def _deb_hashes(digests):
+    # Use the "translated" strings for keys
+    return dict((DEB_HASH_TRANSLATION[x], y) for (x, y) in digests.items())
+
+
 def deb_hash_file(path):
     '''
     Apt Package File uses different syntax
     '''
-    translation = dict(md5="MD5sum", sha1="SHA1", sha256="SHA256")
-    digests = hash_file(path, algs=translation.keys())
-    # Use the "translated" strings for keys
-    hashes = dict((translation[x], y) for (x, y) in digests.items())
-    return hashes
+    digests = hash_file(path, algs=DEB_HASH_TRANSLATION.keys())
+    return _deb_hashes(digests)
+
+
+def deb_hash_files(paths, max_workers=None, cache=None):
+    '''
+    Concurrent version of deb_hash_file.
+    Returns a dictionary mapping each path to a (hashes, size) tuple.
+    '''
+    ret = hash_files(paths, algs=list(DEB_HASH_TRANSLATION),
+                     max_workers=max_workers, cache=cache)
+    return dict((path, (_deb_hashes(digests), size))
+                for (path, (digests, size)) in ret.items())
 
 
 def hash_string(data, algs=['md5', 'sha1', 'sha256']):
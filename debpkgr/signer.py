@@ -98,6 +98,9 @@ class Signer(object):
 
     sign method returns (stdout, stderr)
 
+    sign_many signs several files with a single invocation of the command,
+    which then has to accept multiple file arguments.
+
     """
 
     def __init__(self, options=None):
@@ -109,10 +112,12 @@ class Signer(object):
         self.options = options
 
     def sign(self, path):
+        return self.sign_many([path])
+
+    def sign_many(self, paths):
         if not self.options:
             return
-        cmd = self.options._cmdargs
-        cmd.append(path)
+        cmd = self.options._cmdargs + list(paths)
         stdout = tempfile.NamedTemporaryFile()
         stderr = tempfile.NamedTemporaryFile()
         pobj = subprocess.Popen(
@@ -16,14 +16,26 @@
 
 from __future__ import unicode_literals
 import codecs
+import errno
+import multiprocessing
 import os
 import re
+import shutil
 import string
 from collections import namedtuple
+from concurrent import futures
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .compat import urlopen
 from .compat import urlsplit
 from .compat import urlretrieve
+from .compat import ContentTooShortError
 from .compat import HTTPError
+from .compat import string_types
 from .errors import FileNotFoundError
 
 ENV_NAME_RE = re.compile(r'_{2,}')
@@ -31,6 +43,16 @@ utf8writer = codecs.getwriter('utf-8')
 
 
 DownloadRequest = namedtuple("DownloadRequest", "url destination data")
+# Downloads wait on the network rather than the CPU
+DOWNLOAD_MAX_WORKERS = 8
+# urlretrieve() copies in 8KiB blocks
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+# ioctl that makes a file share the extents of another one (a reflink)
+FICLONE = 0x40049409
+# Errors meaning the filesystem(s) cannot clone, rather than a failure to
+# access the files
+_CLONE_UNSUPPORTED = frozenset([errno.EBADF, errno.EINVAL, errno.ENOTTY,
+                                errno.EOPNOTSUPP, errno.EXDEV])
 
 
 def local_path_from_url(url):
@@ -72,13 +94,108 @@ def download(requests):
     * destination: a destination file or file descriptor
     * data: additional information passed back to the caller at the end of the
     download.
+
+    Downloads are independent of each other, and run concurrently.
     """
-    for req in requests:
-        dest = req.destination
-        opener(req.url, dest)
+    reqs = list(requests)
+    workers = max(1, min(len(reqs), DOWNLOAD_MAX_WORKERS))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consume the results, to re-raise errors
+        for _ in executor.map(_download, reqs):
+            pass
     return requests
 
 
+def _download(req):
+    dest = req.destination
+    local_path = None
+    if urlsplit(req.url).scheme in ('', 'file'):
+        local_path = local_path_from_url(req.url)
+    if not isinstance(dest, string_types):
+        opener(req.url, dest)
+    elif local_path is not None:
+        _copy_local(local_path, dest)
+    else:
+        _fetch(req.url, dest)
+
+
+def _fetch(url, destination):
+    try:
+        resp = urlopen(url)
+    except HTTPError as e:
+        raise FileNotFoundError(
+            'Failed to open %s with %s %s' % (url, e.code, e.reason))
+    try:
+        length = resp.info().get('Content-Length')
+        size = 0
+        with open(destination, 'wb') as fh:
+            while True:
+                block = resp.read(DOWNLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                fh.write(block)
+                size += len(block)
+    finally:
+        resp.close()
+    if length is not None and size < int(length):
+        raise ContentTooShortError(
+            'retrieval incomplete: got only %i out of %s bytes' % (
+                size, length), (destination, None))
+
+
+def _copy_local(path, destination):
+    # Going through urllib for a local file costs extra stat()s and a copy
+    # in small blocks; copyfile can use in-kernel copies
+    try:
+        copyfile(path, destination)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise FileNotFoundError('Failed to open %s: %s' % (path, e))
+
+
+def copyfile(src, dst):
+    """
+    Copy the contents of src to dst.
+
+    On filesystems that support it (btrfs, xfs, ...) the copy is a reflink,
+    which shares the data blocks until either file is modified; otherwise
+    this falls back to shutil.copyfile.
+    """
+    if fcntl is not None and _clone(src, dst):
+        return dst
+    return shutil.copyfile(src, dst)
+
+
+def _clone(src, dst):
+    with open(src, 'rb') as fsrc:
+        try:
+            stobj = os.stat(dst)
+        except OSError:
+            pass
+        else:
+            st_src = os.fstat(fsrc.fileno())
+            if (stobj.st_dev, stobj.st_ino) == (st_src.st_dev, st_src.st_ino):
+                # Let shutil.copyfile complain, instead of truncating src
+                return False
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError) as e:
+                if e.errno not in _CLONE_UNSUPPORTED:
+                    raise
+                return False
+    return True
+
+
+def max_workers(jobs):
+    """
+    Number of workers to use for running jobs concurrently: no more than
+    the number of jobs, or the number of CPUs.
+    """
+    return max(1, min(jobs, multiprocessing.cpu_count()))
+
+
 def makedirs(dirName):
     if os.path.isdir(dirName):
         return dirName
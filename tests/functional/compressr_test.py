@@ -18,8 +18,16 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
+import zlib
+from concurrent import futures
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
 
 from debpkgr import compressr
+from debpkgr import hasher
 
 from tests import base
 
@@ -46,6 +54,11 @@ class DecompressorTest(base.BaseTestCase):
             ['path1/Packages.xz', 'path2/Packages', 'path3/Packages.bz2'],
             ret)
 
+        # Extensions of the same algorithm rank the same; the first wins
+        fnames = ["path1/Packages.bzip2", "path1/Packages.bz2"]
+        self.assertEqual(fnames[:1], dobj.best_choice(fnames))
+        self.assertEqual(fnames[1:], dobj.best_choice(fnames[::-1]))
+
     def _test_open(self, fname_uncompressed, with_uncompressed=True):
         dobj = compressr.Opener()
         file_names = [fname_uncompressed]
@@ -84,6 +97,30 @@ class DecompressorTest(base.BaseTestCase):
         fname_uncompressed = "foo.txt"
         self._test_open(fname_uncompressed, with_uncompressed=True)
 
+    def test_open_compresslevel(self):
+        dobj = compressr.Opener()
+        sizes = []
+        for level in [None, 0]:
+            fname = os.path.join(self.test_dir, "level-{}.gz".format(level))
+            fobj = dobj.open(fname, "wb", compresslevel=level)
+            fobj.write(b"Test" * 1000)
+            fobj.close()
+            self.assertEqual(b"Test" * 1000, dobj.open(fname).read())
+            sizes.append(os.stat(fname).st_size)
+        self.assertTrue(sizes[0] < sizes[1])
+
+        # xz takes the level as its preset
+        data = b"".join(b"Package: foo%d\n\n" % i for i in range(5000))
+        sizes = []
+        for level in [0, 9]:
+            fname = os.path.join(self.test_dir, "level-{}.xz".format(level))
+            fobj = dobj.open(fname, "wb", compresslevel=level)
+            fobj.write(data)
+            fobj.close()
+            self.assertEqual(data, dobj.open(fname).read())
+            sizes.append(os.stat(fname).st_size)
+        self.assertTrue(sizes[0] > sizes[1])
+
     def test_multi_writer(self):
         obj = compressr.MultiWriter(
             os.path.join(self.test_dir, "foo"),
@@ -92,6 +129,161 @@ class DecompressorTest(base.BaseTestCase):
             obj.write(b"Test")
         obj.close()
 
+    def test_multi_writer_hashes(self):
+        fpath = os.path.join(self.test_dir, "foo")
+        obj = compressr.MultiWriter(
+            fpath, extensions=['bz2', 'gz', None], algorithms=['sha256'])
+        for i in range(100):
+            obj.write(b"Test")
+        obj.close()
+        self.assertEqual(
+            sorted([fpath, fpath + ".bz2", fpath + ".gz"]),
+            sorted(obj.hashers))
+        for fname, hobj in obj.hashers.items():
+            self.assertEqual(os.stat(fname).st_size, hobj.size)
+            self.assertEqual(hasher.hash_file(fname, ['sha256']),
+                             hobj.digests)
+        self.assertEqual(b"Test" * 100,
+                         compressr.Opener().open(fpath + ".gz").read())
+
+    def test_multi_writer_gzip_reproducible(self):
+        contents = []
+        for dname in ["a", "b"]:
+            fpath = os.path.join(self.mkdir(dname), "foo")
+            obj = compressr.MultiWriter(fpath, extensions=['gz'])
+            for i in range(100):
+                obj.write(b"Test" * i)
+            obj.close()
+            with open(fpath + ".gz", "rb") as fh:
+                contents.append(fh.read())
+            self.assertEqual(
+                b"".join(b"Test" * i for i in range(100)),
+                compressr.Opener().open(fpath + ".gz").read())
+        # No file name or timestamp in the header
+        self.assertEqual(contents[0], contents[1])
+
+    def test_multi_writer_executor(self):
+        fpath = os.path.join(self.test_dir, "foo")
+        with futures.ThreadPoolExecutor(max_workers=3) as executor:
+            obj = compressr.MultiWriter(
+                fpath, extensions=['bz2', 'gz', None], algorithms=['sha256'],
+                executor=executor)
+            # Some blocks are large enough to be written in parallel
+            obj.PARALLEL_MIN_SIZE = 200
+            for i in range(100):
+                obj.write(b"Test" * i)
+            obj.close()
+        expected = b"".join(b"Test" * i for i in range(100))
+        for fname, hobj in obj.hashers.items():
+            self.assertEqual(os.stat(fname).st_size, hobj.size)
+            self.assertEqual(hasher.hash_file(fname, ['sha256']),
+                             hobj.digests)
+            self.assertEqual(
+                expected,
+                compressr.Opener().open(fname,
+                                        uncompressed=(fname == fpath)).read())
+
+    def test_gzip_writer_threads(self):
+        data = b"".join(b"Package: foo%d\n\n" % i for i in range(5000))
+        contents = []
+        for threads in [1, 3]:
+            fpath = os.path.join(self.test_dir, "foo%d.gz" % threads)
+            with open(fpath, "wb") as fh:
+                obj = compressr.GzipWriter(fh, threads=threads)
+                # Several blocks, some of them compressed concurrently
+                obj.BLOCK_SIZE = 4096
+                for i in range(0, len(data), 10000):
+                    obj.write(data[i:i + 10000])
+                obj.close()
+            self.assertEqual(data, compressr.Opener().open(fpath).read())
+            with open(fpath, "rb") as fh:
+                contents.append(fh.read())
+        # The output does not depend on the number of threads
+        self.assertEqual(contents[0], contents[1])
+
+    def test_gzip_writer_executor(self):
+        data = b"".join(b"Package: foo%d\n\n" % i for i in range(5000))
+        fpath = os.path.join(self.test_dir, "expected.gz")
+        with open(fpath, "wb") as fh:
+            obj = compressr.GzipWriter(fh, threads=2)
+            obj.BLOCK_SIZE = 4096
+            obj.write(data)
+            obj.close()
+        with open(fpath, "rb") as fh:
+            expected = fh.read()
+        # Writers share the pool they are given, and do not start their own
+        fpaths = [os.path.join(self.test_dir, "foo%d.gz" % i)
+                  for i in range(2)]
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            with base.mock.patch(
+                    "debpkgr.compressr.futures.ThreadPoolExecutor") as _TPE:
+                fhs = [open(x, "wb") for x in fpaths]
+                objs = [compressr.GzipWriter(fh, threads=2, executor=executor)
+                        for fh in fhs]
+                for obj in objs:
+                    obj.BLOCK_SIZE = 4096
+                for i in range(0, len(data), 10000):
+                    for obj in objs:
+                        obj.write(data[i:i + 10000])
+                for obj, fh in zip(objs, fhs):
+                    obj.close()
+                    fh.close()
+                self.assertEqual(0, _TPE.call_count)
+        for fpath in fpaths:
+            with open(fpath, "rb") as fh:
+                self.assertEqual(expected, fh.read())
+            self.assertEqual(data, compressr.Opener().open(fpath).read())
+
+    @base.pytest.mark.skipif(isal_zlib is None, reason="isal not installed")
+    def test_gzip_writer_isal(self):
+        self.assertTrue(compressr.zlib is isal_zlib)
+        data = b"".join(b"Package: foo%d\n\n" % i for i in range(5000))
+        # ISA-L levels go from 0 to 3
+        for level in [0, isal_zlib.ISAL_BEST_COMPRESSION]:
+            contents = []
+            for threads in [None, 1, 3]:
+                fpath = os.path.join(
+                    self.test_dir, "foo-%s-%s.gz" % (level, threads))
+                with open(fpath, "wb") as fh:
+                    obj = compressr.GzipWriter(
+                        fh, compresslevel=level, threads=threads)
+                    obj.BLOCK_SIZE = 4096
+                    for i in range(0, len(data), 10000):
+                        obj.write(data[i:i + 10000])
+                    obj.close()
+                with open(fpath, "rb") as fh:
+                    contents.append(fh.read())
+                # Readable by the standard library
+                self.assertEqual(data, zlib.decompress(
+                    contents[-1], compressr.GZIP_WBITS))
+            # Same header (extra flags for the level) whether the stream is
+            # compressed in blocks or not
+            self.assertEqual(contents[0][:10], contents[1][:10])
+            self.assertEqual(4 if level == 0 else 0, contents[1][8])
+            self.assertEqual(contents[1], contents[2])
+
+    def test_multi_writer_replace(self):
+        dname = self.mkdir("out")
+        fpath = self.mkfile(os.path.join(dname, "foo"), contents="Old")
+        with open(fpath, "rb") as fh:
+            obj = compressr.MultiWriter(fpath, extensions=['gz', None])
+            obj.write(b"New")
+            # Nothing is visible until the writer is closed
+            self.assertFalse(os.path.exists(fpath + ".gz"))
+            obj.close()
+            # Readers of the previous file are not affected
+            self.assertEqual(b"Old", fh.read())
+        self.assertEqual(["foo", "foo.gz"], sorted(os.listdir(dname)))
+        with open(fpath, "rb") as fh:
+            self.assertEqual(b"New", fh.read())
+
+        obj = compressr.MultiWriter(fpath, extensions=['gz', None])
+        obj.write(b"Discarded")
+        obj.discard()
+        self.assertEqual(["foo", "foo.gz"], sorted(os.listdir(dname)))
+        with open(fpath, "rb") as fh:
+            self.assertEqual(b"New", fh.read())
+
     def test_maps(self):
         # Make sure that all the maps are sane
         _Algs = compressr.Opener._Decompressor_Factories
@@ -67,10 +67,10 @@ class RepoTest(base.BaseTestCase):
 
         self.packagefile_paths = [u'main/binary-i386/Packages',
                                   u'main/binary-i386/Packages.gz',
-                                  u'main/binary-i386/Packages.bz2',
+                                  u'main/binary-i386/Packages.xz',
                                   u'main/binary-amd64/Packages',
                                   u'main/binary-amd64/Packages.gz',
-                                  u'main/binary-amd64/Packages.bz2']
+                                  u'main/binary-amd64/Packages.xz']
 
     def test_create_repo(self):
         files = []
@@ -111,7 +111,7 @@ class RepoTest(base.BaseTestCase):
 
         packagefile_paths = [u'main/binary-amd64/Packages',
                              u'main/binary-amd64/Packages.gz',
-                             u'main/binary-amd64/Packages.bz2']
+                             u'main/binary-amd64/Packages.xz']
         files = []
         for root, _, fl in os.walk(self.pool_dir):
             for f in fl:
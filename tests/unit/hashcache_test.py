@@ -0,0 +1,99 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+from debpkgr import hasher
+from debpkgr.hashcache import HashCache
+
+from tests import base
+
+
+class HashCacheTest(base.BaseTestCase):
+
+    def setUp(self):
+        super(HashCacheTest, self).setUp()
+        self.data = "Unchained, yeah ya hit the ground running"
+        self.algs = ["md5", "sha256"]
+        self.cache_path = os.path.join(self.test_dir, "cache", "hashes.json")
+
+    def test_hash_files_with_cache(self):
+        filename = self.mkfile("hash_test.txt", contents=self.data)
+        expected = hasher.hash_files([filename], self.algs)
+
+        cache = HashCache(self.cache_path)
+        self.assertEqual(expected,
+                         hasher.hash_files([filename], self.algs, cache=cache))
+        cache.save()
+
+        # A new cache object loads the persisted digests, and nothing gets
+        # hashed
+        cache = HashCache(self.cache_path)
+        with base.mock.patch("debpkgr.hasher.HashFile") as _HashFile:
+            self.assertEqual(
+                expected,
+                hasher.hash_files([filename], self.algs, cache=cache))
+            self.assertEqual(0, _HashFile.call_count)
+
+        # Saving again replaces the previous cache
+        other = self.mkfile("other.txt", contents=self.data)
+        hasher.hash_files([other], self.algs, cache=cache)
+        cache.save()
+        self.assertNotEqual(
+            None, HashCache(self.cache_path).get(other, self.algs))
+
+        # A subset of the cached algorithms is a hit too
+        self.assertEqual(dict(md5=expected[filename][0]['md5']),
+                         cache.get(filename, ["md5"]))
+        # Algorithms that were not cached are a miss
+        self.assertEqual(None, cache.get(filename, ["sha1"]))
+
+    def test_invalidated_on_change(self):
+        filename = self.mkfile("hash_test.txt", contents=self.data)
+        cache = HashCache()
+        hasher.hash_files([filename], self.algs, cache=cache)
+        self.assertNotEqual(None, cache.get(filename, self.algs))
+
+        self.mkfile("hash_test.txt", contents=self.data + "!")
+        self.assertEqual(None, cache.get(filename, self.algs))
+        self.assertEqual(
+            hasher.hash_files([filename], self.algs),
+            hasher.hash_files([filename], self.algs, cache=cache))
+
+    def test_invalidated_on_replace(self):
+        filename = self.mkfile("hash_test.txt", contents=self.data)
+        cache = HashCache()
+        hasher.hash_files([filename], self.algs, cache=cache)
+        stobj = os.stat(filename)
+
+        # Same size and timestamps, but a different file
+        other = self.mkfile("hash_test.new", contents=self.data[::-1])
+        os.utime(other, (stobj.st_atime, stobj.st_mtime))
+        os.rename(other, filename)
+        self.assertEqual(None, cache.get(filename, self.algs))
+
+    def test_corrupt_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, "w") as fh:
+            fh.write("{not json")
+        cache = HashCache(self.cache_path)
+        filename = self.mkfile("hash_test.txt", contents=self.data)
+        self.assertEqual(None, cache.get(filename, self.algs))
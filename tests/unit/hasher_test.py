@@ -54,6 +54,58 @@ class HasherTests(base.BaseTestCase):
             filename = self.mkfile("hash_test.txt", contents=td.data)
             self.assertEqual(td.expected, hasher.hash_file(filename, td.algs))
 
+    def test_HashFile_size(self):
+        filename = self.mkfile("hash_size_test.txt", contents=self.data)
+        hf = hasher.HashFile(filename, algorithms=self.algs)
+        self.assertEqual(len(self.data), hf.size)
+        self.assertEqual(self.expected, hf.digests)
+
+    def test_HashFile_mmap(self):
+        filename = self.mkfile("hash_mmap_test.txt", contents=self.data)
+        hf = hasher.HashFile(filename, algorithms=self.algs)
+        hf.MMAP_MIN_SIZE = 1
+        self.assertEqual(self.expected, hf.digests)
+        self.assertEqual(len(self.data), hf.size)
+
+    @base.mock.patch("debpkgr.utils.max_workers", return_value=3)
+    def test_HashFile_mmap_parallel(self, _max_workers):
+        filename = self.mkfile("hash_mmap_test.txt", contents=self.data)
+        hf = hasher.HashFile(filename, algorithms=self.algs)
+        hf.MMAP_MIN_SIZE = hf.PARALLEL_MIN_SIZE = 1
+        self.assertEqual(self.expected, hf.digests)
+        _max_workers.assert_called_once_with(len(self.algs))
+
+    @base.mock.patch("debpkgr.hasher.HashFile._update_parallel")
+    def test_hash_files_not_parallel(self, _update_parallel):
+        filenames = [self.mkfile("hash_test_%d.txt" % i, contents=self.data)
+                     for i in range(2)]
+        with base.mock.patch.object(hasher.HashFile, "MMAP_MIN_SIZE", 1), \
+                base.mock.patch.object(hasher.HashFile, "PARALLEL_MIN_SIZE", 1):
+            # Several files at once: each is hashed on a single thread
+            ret = hasher.hash_files(filenames, self.algs, max_workers=2)
+            self.assertEqual(0, _update_parallel.call_count)
+            self.assertEqual(self.expected, ret[filenames[0]][0])
+            # One at a time: the algorithms run side by side
+            hasher.hash_files(filenames, self.algs, max_workers=1)
+            self.assertEqual(2, _update_parallel.call_count)
+
+    def test_HashFile_small_blocks(self):
+        filename = self.mkfile("hash_block_test.txt", contents=self.data)
+        hf = hasher.HashFile(filename, algorithms=self.algs)
+        hf.USE_MMAP = False
+        hf.BLOCKSIZE = 7
+        self.assertEqual(self.expected, hf.digests)
+        self.assertEqual(len(self.data), hf.size)
+
+    def test_hash_files(self):
+        filenames = [self.mkfile("hash_test_%d.txt" % i, contents=self.data)
+                     for i in range(3)]
+        ret = hasher.hash_files(filenames, self.algs)
+        self.assertEqual(
+            dict((x, (self.expected, len(self.data))) for x in filenames),
+            ret)
+        self.assertEqual({}, hasher.hash_files([], self.algs))
+
     def test_HashFile_lines(self):
         filename = self.mkfile("deb_hash_test.txt", contents=self.data)
         exp_lines = [
@@ -21,6 +21,7 @@ from __future__ import print_function
 # python-debian expects py2 strings or py3 strings, not py2 unicode
 
 from collections import namedtuple
+from io import BytesIO
 from debian import deb822
 from debian import debfile
 from debpkgr.debpkg import DebPkg
@@ -106,6 +107,49 @@ SHA256: d80568c932f54997713bb7832c6da6aa04992919f3d0f47afb6ba600a7586780
             self.assertFalse(k in pkg._c)
         self.assertTrue(isinstance(pkg.control, deb822.Deb822))
         self.assertTrue(isinstance(pkg.hashes, deb822.Deb822))
+        # Computed once
+        self.assertTrue(pkg.nevra is pkg.nevra)
+        self.assertEqual(pkg.nevra + '.deb', pkg.filename)
+        other = DebPkg(self.control_data, self.md5sum_data, self.hashes_data)
+        self.assertEqual(hash(pkg), hash(other))
+        self.assertEqual(1, len(set([pkg, other])))
+
+        self.assertEqual(DebPkgFiles(self.files_data), pkg.files)
+        # Callers get their own copy
+        pkg.files.append('usr/bin/foo')
+        self.assertEqual(DebPkgFiles(self.files_data), pkg.files)
+
+    def test_pkg_lazy_relations(self):
+        control_data = dict(self.control_data, Depends=u'bar (>= 1.0-6)')
+        scripts = dict(postinst=u'#!/bin/sh\n')
+        with base.mock.patch("debpkgr.debpkg.DebPkgRequires",
+                             wraps=DebPkgRequires) as _DebPkgRequires:
+            pkg = DebPkg(control_data, self.md5sum_data, self.hashes_data,
+                         scripts=scripts)
+            self.assertEqual(u'foo_0.0.1-1_amd64', pkg.nevra)
+            self.assertEqual(0, _DebPkgRequires.call_count)
+            self.assertEqual(u'bar', pkg.depends[0][0]['name'])
+            self.assertEqual(pkg.depends, pkg.dependencies['depends'])
+            # Parsed once
+            self.assertEqual(1, _DebPkgRequires.call_count)
+        self.assertEqual(u'#!/bin/sh\n', pkg.scripts.postinst)
+        self.assertTrue(pkg.scripts is pkg.scripts)
+
+    def test_pkg_packages_stanza(self):
+        pkg = DebPkg(self.control_data, self.md5sum_data, self.hashes_data)
+        stanza = pkg.packages_stanza
+        self.assertEqual(self.package_obj,
+                         deb822.Deb822(stanza.decode('utf-8')))
+        # Computed once
+        self.assertTrue(stanza is pkg.packages_stanza)
+        fh = BytesIO()
+        pkg.dump(fh)
+        self.assertEqual(stanza, fh.getvalue())
+
+        pkg.relative_path = 'pool/main/f/foo/foo_0.0.1-1_amd64.deb'
+        self.assertEqual(
+            'pool/main/f/foo/foo_0.0.1-1_amd64.deb',
+            deb822.Deb822(pkg.packages_stanza.decode('utf-8'))['Filename'])
 
     def test_pkg_md5sums(self):
         md5sums = DebPkgMD5sums(self.md5sum_data)
@@ -119,6 +163,8 @@ SHA256: d80568c932f54997713bb7832c6da6aa04992919f3d0f47afb6ba600a7586780
         files = DebPkgFiles(self.files_data)
         self.assertEqual([x for x in files], self.files_data)
         self.assertEqual(files, self.files_data)
+        self.assertEqual(files, DebPkgFiles(self.files_data[::-1]))
+        self.assertNotEqual(files, DebPkgFiles(self.files_data[1:]))
         self.assertNotEqual(files, self.attrs_data)
         self.assertNotEqual(files, self.hashes_data)
         self.assertEqual(str(files), self.files_string)
@@ -142,6 +188,21 @@ SHA256: d80568c932f54997713bb7832c6da6aa04992919f3d0f47afb6ba600a7586780
 
         empty = DebPkgRequires()
         self.assertTrue(defaults, empty)
+        # Defaults must not be shared between instances
+        empty.depends.append('foo')
+        self.assertEqual([], DebPkgRequires().depends)
+
+        # Fields are parsed as they are read, and only once
+        with base.mock.patch.object(DebPkgRequires, "parse",
+                                    wraps=DebPkgRequires.parse) as _parse:
+            requires = DebPkgRequires(Depends=u'foo', Breaks=u'bar')
+            self.assertEqual(0, _parse.call_count)
+            self.assertEqual(u'foo', requires.depends[0][0]['name'])
+            self.assertTrue(requires.depends is requires.depends)
+            self.assertEqual([], requires.recommends)
+            self.assertEqual(1, _parse.call_count)
+            self.assertEqual(sorted(defaults), sorted(requires.relations))
+            self.assertEqual(2, _parse.call_count)
 
         version_string = (u'foo (<<3.0-4), bar (<=1.5-0), baz (=1.2.0)'
                           ', caz (>= 1.0-6), cuz (>>4.0.0-1)')
@@ -430,6 +491,9 @@ SHA256: d80568c932f54997713bb7832c6da6aa04992919f3d0f47afb6ba600a7586780
         self.assertTrue(foos[0] != bars[0])
         self.assertFalse(foos[0] == bars[0])
         self.assertFalse(foos[0] == foos[1])
+        self.assertTrue(foos[1] > foos[0])
+        self.assertFalse(foos[0] == 'foo_0.0.1-1_amd64')
+        self.assertTrue(foos[0] != 'foo_0.0.1-1_amd64')
         _all = sorted(foos + bars)
         _all_versions = [x.nevra for x in _all]
         for index in range(len(expected)):
@@ -19,12 +19,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import hashlib
 import os
+from tempfile import mkstemp as orig_mkstemp
 from time import gmtime as orig_gmtime
 from io import BytesIO
 
 from debpkgr.aptrepo import AptRepoMeta, AptRepo
 from debpkgr.aptrepo import create_repo, parse_repo
+from debpkgr import compressr
+from debpkgr import utils
 from debian import deb822
 from debpkgr.signer import SignOptions, SignerError
 from tests import base
@@ -159,6 +164,18 @@ class RepoTest(base.BaseTestCase):
             "Architecture BOGUS not defined (expected: amd64, i386, aarch64)",
             str(ctx.exception))
 
+        obj = repo_meta.get_component_arch_binary('main', 'amd64')
+        self.assertTrue(
+            obj is repo_meta.get_component_arch_binary('main', 'amd64'))
+        repo_meta.init_component_arch_binaries()
+        self.assertEqual(
+            [('main', 'amd64'), ('main', 'i386'), ('main', 'aarch64'),
+             ('updates', 'amd64'), ('updates', 'i386'),
+             ('updates', 'aarch64')],
+            [(x.component, x.architecture)
+             for x in repo_meta.iter_component_arch_binaries()])
+        self.assertEqual(6, len(repo_meta._component_arch_binaries))
+
     @base.mock.patch("debpkgr.aptrepo.time.strftime")
     def test_metadata(self, _strftime):
         _strftime.return_value = "ABCDE"
@@ -206,6 +223,241 @@ class RepoTest(base.BaseTestCase):
 
         self.assertEqual(expected, ret)
 
+    @base.mock.patch("debpkgr.hasher.HashFile")
+    def test_metadata_create_hashes_while_writing(self, _HashFile):
+        repo_meta = AptRepoMeta(**self.defaults)
+        repo_meta.create(self.new_repo_dir)
+        # Checksums are computed as the files are written, nothing is read
+        # back
+        self.assertEqual(0, _HashFile.call_count)
+
+        release_dir = repo_meta.release_dir(self.new_repo_dir)
+        with open(repo_meta.release_path(self.new_repo_dir), "rb") as fh:
+            fields = list(deb822.Release(fh))
+        # The date is refreshed in place, ahead of the checksums
+        self.assertTrue(fields.index('Date') < fields.index('SHA256'))
+        self.assertEqual(['MD5sum', 'SHA1', 'SHA256'], fields[-3:])
+        entries = repo_meta.release['SHA256']
+        self.assertEqual(
+            len(self.components) * len(self.arches) * 3, len(entries))
+        for entry in entries:
+            path = os.path.join(release_dir, entry['name'])
+            self.assertEqual(str(os.stat(path).st_size), entry['size'])
+            self.assertEqual(
+                hashlib.sha256(open(path, "rb").read()).hexdigest(),
+                entry['sha256'])
+
+    @base.mock.patch.object(AptRepoMeta, "_Packages_Compression_Types",
+                            ['bz2'])
+    def test_metadata_create_compression_types(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        repo_meta.create(self.new_repo_dir)
+        self.assertEqual(
+            ['main/binary-amd64/Packages', 'main/binary-amd64/Packages.bz2'],
+            [x['name'] for x in repo_meta.release['SHA256']][:2])
+
+    def test_metadata_estimated_package_count(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        comp_binary = repo_meta.get_component_arch_binary('main', 'amd64')
+        self.assertEqual(0, comp_binary.estimated_package_count())
+        comp_binary.packages_file = open(
+            self.mkfile("Packages", contents="x" * 4096), "rb")
+        self.assertEqual(4, comp_binary.estimated_package_count())
+        comp_binary.packages_file.close()
+        comp_binary.packages_file = BytesIO(b"x" * 4096)
+        self.assertEqual(0, comp_binary.estimated_package_count())
+        comp_binary.add_package(object())
+        self.assertEqual(1, comp_binary.estimated_package_count())
+
+    def test_metadata_load_packages(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        comp_binary = repo_meta.get_component_arch_binary('main', 'amd64')
+        path = os.path.join(self.new_repo_dir,
+                            comp_binary.relative_path('Packages'))
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fh:
+            fh.write(u"Package: foo\nMaintainer: J\u00fcrgen\n\n"
+                     u"Package: bar\n".encode('utf-8'))
+        comp_binary.load_packages(self.new_repo_dir)
+        pkgs = list(comp_binary.iter_packages())
+        comp_binary.packages_file.close()
+        self.assertEqual(['foo', 'bar'], [x['Package'] for x in pkgs])
+        self.assertEqual(u"J\u00fcrgen", pkgs[0]['Maintainer'])
+
+    def test_metadata_WritePackages_compression_types(self):
+        release_dir = os.path.join(self.test_dir, 'dists', 'stable')
+        short_names, checksums = AptRepoMeta.WritePackages(
+            self.test_dir, release_dir, 'main/binary-amd64/Packages', [],
+            compression_types=['bz2', 'xz'])
+        self.assertEqual(
+            ['main/binary-amd64/Packages', 'main/binary-amd64/Packages.bz2',
+             'main/binary-amd64/Packages.xz'],
+            short_names)
+        self.assertEqual(short_names,
+                         [x['name'] for x in checksums['SHA256']])
+
+        with self.assertRaises(ValueError) as ctx:
+            AptRepoMeta.WritePackages(
+                self.test_dir, release_dir, 'main/binary-amd64/Packages', [],
+                compression_types=['zip'])
+        self.assertEqual("Unsupported compression types: zip",
+                         str(ctx.exception))
+
+    def test_metadata_WritePackages_hash_algorithms(self):
+        release_dir = os.path.join(self.test_dir, 'dists', 'stable')
+        short_names, checksums = AptRepoMeta.WritePackages(
+            self.test_dir, release_dir, 'main/binary-amd64/Packages', [],
+            hash_algorithms=['sha256'])
+        self.assertEqual(['SHA256'], list(checksums))
+        self.assertEqual(short_names,
+                         [x['name'] for x in checksums['SHA256']])
+
+        with self.assertRaises(ValueError) as ctx:
+            AptRepoMeta.WritePackages(
+                self.test_dir, release_dir, 'main/binary-amd64/Packages', [],
+                hash_algorithms=['sha256', 'crc32'])
+        self.assertEqual("Unsupported hash algorithms: crc32",
+                         str(ctx.exception))
+
+        repo_meta = AptRepoMeta(hash_algorithms=['sha256'], **self.defaults)
+        repo_meta.create(self.new_repo_dir)
+        self.assertIn('SHA256', repo_meta.release)
+        self.assertNotIn('MD5Sum', repo_meta.release)
+        self.assertNotIn('SHA1', repo_meta.release)
+
+    def test_metadata_create_by_hash(self):
+        repo_meta = AptRepoMeta(acquire_by_hash=True, **self.defaults)
+        repo_meta.create(self.new_repo_dir)
+        self.assertEqual('yes', repo_meta.release['Acquire-By-Hash'])
+        release_dir = repo_meta.release_dir(self.new_repo_dir)
+        for entry in repo_meta.release['SHA256']:
+            path = os.path.join(release_dir, entry['name'])
+            link = os.path.join(os.path.dirname(path), 'by-hash', 'SHA256',
+                                entry['sha256'])
+            self.assertTrue(os.path.samefile(path, link))
+
+        with self.assertRaises(ValueError) as ctx:
+            AptRepoMeta.WritePackages(
+                self.test_dir, release_dir, 'main/binary-amd64/Packages', [],
+                hash_algorithms=['md5'], by_hash=True)
+        self.assertEqual("by-hash publishing requires sha256",
+                         str(ctx.exception))
+
+    def test_metadata_create_gzip_executor(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        with base.mock.patch("debpkgr.compressr.GzipWriter",
+                             wraps=compressr.GzipWriter) as _GzipWriter:
+            repo_meta.create(self.new_repo_dir)
+        # All the Packages.gz files share one pool for their blocks
+        executors = set(x[1]['executor'] for x in _GzipWriter.call_args_list)
+        self.assertEqual(len(list(repo_meta.iter_component_arch_binaries())),
+                         _GzipWriter.call_count)
+        self.assertEqual(1, len(executors))
+        self.assertNotIn(None, executors)
+
+    def test_metadata_WritePackages_stale_variants(self):
+        release_dir = self.mkdir("dists")
+        packages = [deb822.Packages(dict(Package='foo'))]
+        short_names, _ = AptRepoMeta.WritePackages(
+            self.test_dir, release_dir, 'main/binary-amd64/Packages',
+            packages, compression_types=['bz2', 'gz', 'xz'])
+        self.assertIn('main/binary-amd64/Packages.bz2', short_names)
+        # With the defaults, the bz2 file left from the previous run goes
+        short_names, _ = AptRepoMeta.WritePackages(
+            self.test_dir, release_dir, 'main/binary-amd64/Packages',
+            packages)
+        self.assertNotIn('main/binary-amd64/Packages.bz2', short_names)
+        self.assertEqual(
+            sorted(os.path.basename(x) for x in short_names),
+            sorted(os.listdir(
+                os.path.join(release_dir, 'main', 'binary-amd64'))))
+
+    @base.mock.patch.object(AptRepoMeta, "_BY_HASH_KEEP", 1)
+    def test_metadata_by_hash_pruned(self):
+        release_dir = self.mkdir("dists")
+        by_hash_dir = os.path.join(
+            release_dir, 'main', 'binary-amd64', 'by-hash', 'SHA256')
+        generations = []
+        for i in range(3):
+            packages = [deb822.Packages(dict(Package='foo%d' % i))]
+            _, checksums = AptRepoMeta.WritePackages(
+                self.test_dir, release_dir, 'main/binary-amd64/Packages',
+                packages, by_hash=True)
+            generations.append(set(x['sha256'] for x in checksums['SHA256']))
+            # Make the previous generations older
+            for name in os.listdir(by_hash_dir):
+                path = os.path.join(by_hash_dir, name)
+                mtime = os.lstat(path).st_mtime - 100
+                os.utime(path, (mtime, mtime))
+        # The current files and the previous generation are kept
+        self.assertEqual(generations[1] | generations[2],
+                         set(os.listdir(by_hash_dir)))
+
+    @base.mock.patch("debpkgr.aptrepo.hash_file")
+    def test_metadata_validate_downloads_size(self, _hash_file):
+        repo_meta = AptRepoMeta(**self.defaults)
+        dest = self.mkfile("Packages", contents="Package: foo\n")
+        data = dict(name="main/binary-amd64/Packages", size="1000",
+                    sha256="abc", component="main", architecture="amd64")
+        dl_req = utils.DownloadRequest("/dev/null", dest, data)
+        with self.assertRaises(Exception) as ctx:
+            repo_meta.validate_component_arch_packages_downloads([dl_req])
+        self.assertEqual("Size did not match", str(ctx.exception))
+        # A download with the wrong size is not hashed
+        self.assertEqual(0, _hash_file.call_count)
+
+    def test_metadata_validate_downloads_compressed(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        contents = b"Package: foo\n"
+        dest = os.path.join(self.test_dir, "Packages.gz")
+        with gzip.open(dest, "wb") as fh:
+            fh.write(contents)
+        with open(dest, "rb") as fh:
+            sha256 = hashlib.sha256(fh.read()).hexdigest()
+        data = dict(name="main/binary-amd64/Packages.gz", sha256=sha256,
+                    component="main", architecture="amd64")
+
+        # A corrupted download is hashed while it is decompressed; on a
+        # mismatch, the decompressed file is removed and the download kept
+        bad_req = utils.DownloadRequest(
+            "/dev/null", dest, dict(data, sha256="abc"))
+        with self.assertRaises(Exception) as ctx:
+            repo_meta.validate_component_arch_packages_downloads([bad_req])
+        self.assertEqual("Checksum did not match", str(ctx.exception))
+        self.assertTrue(os.path.exists(dest))
+        self.assertFalse(os.path.exists(dest[:-3]))
+
+        dl_req = utils.DownloadRequest("/dev/null", dest, data)
+        repo_meta.validate_component_arch_packages_downloads([dl_req])
+        comp_binary = repo_meta.get_component_arch_binary('main', 'amd64')
+        self.assertEqual(contents, comp_binary.packages_file.read())
+        comp_binary.packages_file.close()
+        self.assertFalse(os.path.exists(dest))
+
+    def test_metadata_validate_downloads_partial_failure(self):
+        repo_meta = AptRepoMeta(**self.defaults)
+        arches = repo_meta.architectures[:2]
+        reqs = []
+        for i, arch in enumerate(arches):
+            dest = os.path.join(self.mkdir(arch), "Packages.gz")
+            with gzip.open(dest, "wb") as fh:
+                fh.write(b"Package: foo\n")
+            with open(dest, "rb") as fh:
+                sha256 = hashlib.sha256(fh.read()).hexdigest()
+            if i:
+                sha256 = "abc"
+            reqs.append(utils.DownloadRequest(
+                "/dev/null", dest,
+                dict(name="main/binary-%s/Packages.gz" % arch, sha256=sha256,
+                     component="main", architecture=arch)))
+        with self.assertRaises(Exception) as ctx:
+            repo_meta.validate_component_arch_packages_downloads(reqs)
+        self.assertEqual("Checksum did not match", str(ctx.exception))
+        # The valid download is left as it was too
+        for req in reqs:
+            self.assertTrue(os.path.exists(req.destination))
+            self.assertFalse(os.path.exists(req.destination[:-3]))
+
     def test_metadata_not_shared(self):
         # Make sure defaults are not shared between objects
         rel = deb822.Release(dict(Architectures="amd64 i386 aarch64"))
@@ -218,6 +470,13 @@ class RepoTest(base.BaseTestCase):
         md2 = AptRepoMeta(rel)
         self.assertEqual(['amd64', 'i386', 'aarch64'], md2.architectures)
 
+        # The returned list is a copy, and changes made directly to the
+        # release are picked up
+        md2.architectures.append('BOGUS')
+        self.assertEqual(['amd64', 'i386', 'aarch64'], md2.architectures)
+        md2.release['Architectures'] = 'arm64'
+        self.assertEqual(['arm64'], md2.architectures)
+
     @base.mock.patch("debpkgr.aptrepo.time.gmtime")
     def test_set_date(self, _gmtime):
         _gmtime.return_value = orig_gmtime(1234567890.123)
@@ -312,6 +571,13 @@ class RepoTest(base.BaseTestCase):
 
             self.assertEqual(exp_filenames, [x['Filename'] for x in pkgs])
 
+    def test_AptRepo_add_package_dangling_symlink(self):
+        repo = AptRepo(self.new_repo_dir, AptRepoMeta(**self.defaults))
+        dst = os.path.join(self.new_repo_dir, "foo.deb")
+        os.symlink(os.path.join(self.test_dir, "missing.deb"), dst)
+        repo._add_package(self.files[0], dst, with_symlinks=True)
+        self.assertEqual(self.files[0], os.readlink(dst))
+
     @base.mock.patch("debpkgr.aptrepo.tempfile.NamedTemporaryFile")
     @base.mock.patch("debpkgr.signer.subprocess.Popen")
     def test_AptRepo_sign(self, _Popen, _NamedTemporaryFile):
@@ -354,6 +620,15 @@ class RepoTest(base.BaseTestCase):
             _NamedTemporaryFile.return_value,
             ctx.exception.stderr)
 
+    def test_AptRepo_default_hash_cache(self):
+        repo = AptRepo(self.new_repo_dir, AptRepoMeta(**self.defaults))
+        deb = os.path.join(self.pool_dir, "f", "foo", "foo_0.0.1-1_amd64.deb")
+        repo.add_packages([deb], component="main", architecture="amd64")
+        # Adding the same file again does not hash it a second time
+        with base.mock.patch("debpkgr.hasher.HashFile") as _HashFile:
+            repo.add_packages([deb], component="main", architecture="i386")
+            self.assertEqual(0, _HashFile.call_count)
+
     def test_AptRepo_repo_name(self):
         meta = AptRepoMeta(codename='aaa')
         repo = AptRepo(self.new_repo_dir, metadata=meta)
@@ -373,7 +648,8 @@ class RepoTest(base.BaseTestCase):
         self.assertEqual(aptrepo, repo)
 
         _AptRepo.assert_called_once_with(self.new_repo_dir,
-                                         metadata=_AptRepoMeta.return_value)
+                                         metadata=_AptRepoMeta.return_value,
+                                         hash_cache=None)
         _AptRepoMeta.asset_called_once_with(origin=origin,
                                             label=origin,
                                             codename=self.name,
@@ -391,6 +667,24 @@ class RepoTest(base.BaseTestCase):
         _parse.assert_called_once_with(self.new_repo_dir,
                                        upstream, codename='stable')
 
+    def test_AptRepo_parse_release(self):
+        temp_files = []
+
+        def mkstemp(*args, **kwargs):
+            ret = orig_mkstemp(*args, **kwargs)
+            temp_files.append(ret[1])
+            return ret
+
+        with base.mock.patch("debpkgr.aptrepo.tempfile.mkstemp",
+                             side_effect=mkstemp):
+            repo = AptRepo.parse_release(
+                self.new_repo_dir, self.current_repo_dir, codename='stable')
+        self.assertEqual('stable', repo.metadata.codename)
+        self.assertNotEqual([], repo.metadata.release['SHA256'])
+        # The downloaded Release file is removed
+        self.assertEqual(1, len(temp_files))
+        self.assertFalse(os.path.exists(temp_files[0]))
+
     def test_apt_repo_bad_signing_options(self):
         meta = AptRepoMeta(codename=self.name)
         with self.assertRaises(ValueError) as ctx:
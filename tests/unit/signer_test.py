@@ -70,6 +70,32 @@ class SignerTestSign(SignerBaseTest):
             stderr=_NamedTemporaryFile.return_value,
         )
 
+    @base.mock.patch("debpkgr.signer.tempfile.NamedTemporaryFile")
+    @base.mock.patch("debpkgr.signer.subprocess.Popen")
+    def test_sign_many(self, _Popen, _NamedTemporaryFile):
+        filenames = [self.mkfile(x, contents="Name: %s" % x)
+                     for x in ["Release", "InRelease"]]
+        so = SignOptions(cmd=self.sign_cmd)
+
+        _Popen.return_value.wait.return_value = 0
+        signer = Signer(options=so)
+        signer.sign_many(filenames)
+        # Signing again should not accumulate file arguments
+        signer.sign(filenames[0])
+
+        self.assertEqual(
+            [base.mock.call(
+                [self.sign_cmd] + filenames,
+                env=dict(GPG_CMD=self.sign_cmd),
+                stdout=_NamedTemporaryFile.return_value,
+                stderr=_NamedTemporaryFile.return_value),
+             base.mock.call(
+                [self.sign_cmd, filenames[0]],
+                env=dict(GPG_CMD=self.sign_cmd),
+                stdout=_NamedTemporaryFile.return_value,
+                stderr=_NamedTemporaryFile.return_value)],
+            _Popen.call_args_list)
+
     @base.mock.patch("debpkgr.signer.tempfile.NamedTemporaryFile")
     @base.mock.patch("debpkgr.signer.subprocess.Popen")
     def test_sign_error(self, _Popen, _NamedTemporaryFile):
@@ -19,9 +19,13 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import errno
 import os
+import shutil
 from collections import namedtuple
 
+from debpkgr import errors
+from debpkgr.compat import ContentTooShortError
 from debpkgr import utils
 
 from tests import base
@@ -45,6 +49,61 @@ class UtilsTests(base.BaseTestCase):
         for td in tests:
             self.assertEqual(td.expected, utils.local_path_from_url(td.data))
 
+    def test_download_local(self):
+        src = self.mkfile("src.txt", contents="Some contents")
+        dests = [os.path.join(self.test_dir, "dest%d.txt" % i)
+                 for i in range(2)]
+        reqs = [utils.DownloadRequest(src, dests[0], None),
+                utils.DownloadRequest("file://" + src, dests[1], None)]
+        self.assertEqual(reqs, utils.download(reqs))
+        for dest in dests:
+            with open(dest) as fh:
+                self.assertEqual("Some contents", fh.read())
+
+        req = utils.DownloadRequest(os.path.join(self.test_dir, "missing"),
+                                    dests[0], None)
+        self.assertRaises(errors.FileNotFoundError, utils.download, [req])
+
+    @base.mock.patch("debpkgr.utils.urlopen")
+    def test_download_remote(self, _urlopen):
+        contents = b"Some contents" * 1000
+        _urlopen.return_value.read.side_effect = [
+            contents[:5000], contents[5000:], b""]
+        _urlopen.return_value.info.return_value = {
+            'Content-Length': str(len(contents))}
+        dest = os.path.join(self.test_dir, "dest.txt")
+        url = "http://example.com/src.txt"
+        utils.download([utils.DownloadRequest(url, dest, None)])
+        _urlopen.assert_called_once_with(url)
+        with open(dest, "rb") as fh:
+            self.assertEqual(contents, fh.read())
+
+        _urlopen.return_value.read.side_effect = [contents[:5000], b""]
+        self.assertRaises(
+            ContentTooShortError, utils.download,
+            [utils.DownloadRequest(url, dest, None)])
+
+    def test_copyfile(self):
+        src = self.mkfile("src.txt", contents="Some contents")
+        dest = os.path.join(self.test_dir, "dest.txt")
+        with base.mock.patch("debpkgr.utils.fcntl") as _fcntl:
+            # The filesystem cannot clone: the contents are copied
+            _fcntl.ioctl.side_effect = OSError(errno.EOPNOTSUPP, "Nope")
+            self.assertEqual(dest, utils.copyfile(src, dest))
+            with open(dest) as fh:
+                self.assertEqual("Some contents", fh.read())
+
+            _fcntl.ioctl.side_effect = None
+            with base.mock.patch("debpkgr.utils.shutil") as _shutil:
+                self.assertEqual(dest, utils.copyfile(src, dest))
+                self.assertEqual(0, _shutil.copyfile.call_count)
+            self.assertEqual(utils.FICLONE, _fcntl.ioctl.call_args[0][1])
+
+            # Copying a file onto itself does not truncate it
+            self.assertRaises(shutil.Error, utils.copyfile, src, src)
+            with open(src) as fh:
+                self.assertEqual("Some contents", fh.read())
+
     def test_normalize_paths(self):
         TestPath = namedtuple("TestPath", "data expected")
         tests = [TestPath(u"file:////a",